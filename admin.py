@@ -0,0 +1,41 @@
+import json
+
+import webapp2
+
+import models
+import stats
+
+
+class MigrateUsersHandler (webapp2.RequestHandler):
+    """ Request handler for re-keying users stored before users were keyed
+    by their user ID. Only administrators can reach it (see app.yaml).
+    """
+
+    def post(self):
+        migrated = models.User.migrate()
+        self.response.headers["Content-Type"] = "application/json"
+        self.response.out.write(json.dumps({"migrated": migrated}))
+
+
+class StatsHandler (webapp2.RequestHandler):
+    """ Request handler for the timings and counters of the most recent runs
+    of the notification pipeline, as JSON.
+    """
+
+    def get(self):
+        self.response.headers["Content-Type"] = "application/json"
+        self.response.out.write(json.dumps({
+                "fetch": stats.recent("fetch"),
+                "deliver": stats.recent("deliver"),
+        }, indent=2, sort_keys=True))
+
+
+class ExpireLedgersHandler (webapp2.RequestHandler):
+    """ Request handler for deleting delivery ledgers whose entries have all
+    expired. Run by cron (see cron.yaml).
+    """
+
+    def get(self):
+        expired = models.DeliveryLedger.expire()
+        self.response.headers["Content-Type"] = "application/json"
+        self.response.out.write(json.dumps({"expired": expired}))
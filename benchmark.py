@@ -0,0 +1,213 @@
+""" Benchmark for the earthquake notification pipeline.
+
+Runs QuakeDataFetchHandler.process end to end, from parsing a synthetic USGS
+feed through matching, rendering, maps and delivery, against the App Engine
+SDK's in-memory datastore and memcache, a fakes.FakeMirror and a
+fakes.FakeStaticMaps. Reports latency percentiles and throughput for every
+combination of the given sizes. Round trips include one per card with a
+map, since the Mirror API can't batch uploads. Run it from the application
+directory, with client_secrets.json in place, since the application modules
+load it.
+
+    python benchmark.py --sdk ~/google_appengine \\
+            --quakes 10,100 --users 100,1000 --lois 1,5 --repeat 5
+"""
+import argparse
+import io
+import itertools
+import json
+import os
+import random
+import sys
+import time
+
+
+def setup_paths(sdk):
+    """ Make the App Engine SDK and the bundled libraries importable. """
+    sys.path.insert(0, sdk)
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+    sys.path.insert(0, os.path.join(os.path.dirname(__file__) or ".", "lib"))
+
+
+def synthetic_feed(quakes, centers, hit_rate, rng):
+    """ Make the text of a USGS GeoJSON feed.
+
+    quakes (int): number of earthquakes in the feed.
+    centers (list): (lon, lat) points that some earthquakes land near.
+    hit_rate (float): fraction of earthquakes that land near a center.
+    rng (random.Random): source of randomness.
+    """
+    now = int(time.time() * 1000)
+    features = []
+    for i in range(quakes):
+        if centers and rng.random() < hit_rate:
+            lon, lat = rng.choice(centers)
+            lon += rng.uniform(-0.2, 0.2)
+            lat += rng.uniform(-0.2, 0.2)
+        else:
+            lon, lat = rng.uniform(-180, 180), rng.uniform(-80, 80)
+        features.append({
+                "type": "Feature",
+                "id": "bench%08d" % i,
+                "properties": {
+                        "mag": round(rng.uniform(1.0, 7.0), 1),
+                        "place": "%d km N of Somewhere" % rng.randint(1, 99),
+                        # Recent enough to count as new on a first fetch.
+                        "time": now - rng.randint(0, 20 * 60 * 1000),
+                        "updated": now,
+                },
+                "geometry": {"type": "Point", "coordinates":
+                        [max(-180.0, min(180.0, lon)), lat,
+                        rng.uniform(0, 50)]},
+        })
+    return json.dumps({
+            "type": "FeatureCollection",
+            "metadata": {"generated": now, "count": quakes},
+            "features": features,
+    })
+
+
+def percentile(values, p):
+    """ Get the p-th percentile (0-100) of some values. """
+    values = sorted(values)
+    index = (len(values) - 1) * p / 100.0
+    low = int(index)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (index - low)
+
+
+def run_case(quakes, users, lois, repeat, hit_rate, latency, seed):
+    """ Benchmark one combination of sizes in a fresh in-memory datastore.
+    Returns a dict of results.
+    """
+    from google.appengine.ext import ndb
+    from google.appengine.ext import testbed
+
+    import fakes
+    import feed
+    import fetch
+    import mapcache
+    import models
+    import scheduler
+
+    bed = testbed.Testbed()
+    bed.activate()
+    bed.init_datastore_v3_stub()
+    bed.init_memcache_stub()
+    ndb.get_context().set_cache_policy(False)
+    try:
+        rng = random.Random(seed)
+
+        # Users and their locations of interest.
+        centers = []
+        entities = []
+        for u in range(users):
+            user_id = "user%06d" % u
+            entities.append(models.User(id=user_id, user_id=user_id))
+            for l in range(lois):
+                lon, lat = rng.uniform(-170, 170), rng.uniform(-70, 70)
+                centers.append((lon, lat))
+                entities.append(models.LocationOfInterest(owner=user_id,
+                        description="loi %d" % l,
+                        location=ndb.GeoPt(lat, lon)))
+        for start in range(0, len(entities), 500):
+            ndb.put_multi(entities[start:start + 500])
+        models.LocationOfInterest.invalidate()
+        text = synthetic_feed(quakes, centers, hit_rate, rng)
+
+        # Deliver in this process, to fakes.
+        mirror_service = fakes.FakeMirror(latency)
+        static_maps = fakes.FakeStaticMaps(latency)
+        class BenchShardHandler (fetch.DeliveryShardHandler):
+            def mirror_for(self, user_id):
+                return mirror_service
+        fetch.delivery_queue = fetch.local_queue(BenchShardHandler)
+
+        latencies = []
+        for r in range(repeat):
+            # Every repeat delivers the same earthquakes, so it starts from
+            # empty delivery ledgers and full allowances. Otherwise the
+            # ledger would leave them out as already sent.
+            ndb.delete_multi(models.DeliveryLedger.query().fetch(
+                    keys_only=True))
+            fetch.quota = scheduler.TokenBucket(fetch.QUOTA_RATE,
+                    fetch.QUOTA_BURST)
+            mapcache.maps = mapcache.MapImageCache(use_memcache=False,
+                    download=static_maps)
+            handler = fetch.QuakeDataFetchHandler()
+            reader = feed.FeedReader(io.BytesIO(text))
+            start = time.time()
+            handler.process(handler.stats.timed("parse", reader),
+                    reader.header(), models.FeedState(id="bench%d" % r),
+                    reader)
+            latencies.append(time.time() - start)
+        stages = handler.stats.as_dict()["stages"]
+    finally:
+        bed.deactivate()
+
+    total = sum(latencies)
+    return {
+            "quakes": quakes,
+            "users": users,
+            "lois": lois,
+            "p50_ms": percentile(latencies, 50) * 1000,
+            "p90_ms": percentile(latencies, 90) * 1000,
+            "p99_ms": percentile(latencies, 99) * 1000,
+            "quakes_per_s": quakes * repeat / total if total else 0.0,
+            "cards_per_repeat": len(mirror_service.items) / float(repeat),
+            "round_trips_per_repeat": mirror_service.round_trips / float(repeat),
+            "map_downloads": static_maps.downloads,
+            "stages": dict((name, round(stage["seconds"] * 1000, 3))
+                    for name, stage in stages.items()),
+    }
+
+
+def sizes(text):
+    return [int(size) for size in text.split(",")]
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+            description="Benchmark the earthquake notification pipeline.")
+    parser.add_argument("--sdk", default=os.environ.get("APPENGINE_SDK",
+            os.path.expanduser("~/google_appengine")),
+            help="path to the App Engine Python SDK")
+    parser.add_argument("--quakes", type=sizes, default=[10, 100],
+            help="comma-separated numbers of earthquakes in the feed")
+    parser.add_argument("--users", type=sizes, default=[100, 1000],
+            help="comma-separated numbers of users")
+    parser.add_argument("--lois", type=sizes, default=[1, 5],
+            help="comma-separated numbers of locations of interest per user")
+    parser.add_argument("--repeat", type=int, default=5,
+            help="runs of each combination")
+    parser.add_argument("--hit-rate", type=float, default=0.5,
+            help="fraction of earthquakes near some location of interest")
+    parser.add_argument("--latency", type=float, default=0.0,
+            help="seconds of simulated latency per Mirror/Maps round trip")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", action="store_true",
+            help="print results as JSON lines instead of a table")
+    args = parser.parse_args(argv)
+    setup_paths(args.sdk)
+
+    if not args.json:
+        print "%7s %7s %5s %10s %10s %10s %10s %8s %8s" % ("quakes", "users",
+                "lois", "p50 ms", "p90 ms", "p99 ms", "quakes/s", "cards",
+                "trips")
+    for quakes, users, lois in itertools.product(args.quakes, args.users,
+            args.lois):
+        result = run_case(quakes, users, lois, args.repeat, args.hit_rate,
+                args.latency, args.seed)
+        if args.json:
+            print json.dumps(result, sort_keys=True)
+        else:
+            print "%7d %7d %5d %10.1f %10.1f %10.1f %10.1f %8.0f %8.0f" % (
+                    quakes, users, lois, result["p50_ms"], result["p90_ms"],
+                    result["p99_ms"], result["quakes_per_s"],
+                    result["cards_per_repeat"],
+                    result["round_trips_per_repeat"])
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
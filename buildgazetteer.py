@@ -0,0 +1,134 @@
+""" Build the gazetteer that gazetteer.py geocodes place names with.
+
+Takes a GeoNames dump, such as cities15000.txt, and optionally the matching
+admin1CodesASCII.txt for region names:
+
+    python buildgazetteer.py cities15000.txt --admin1 admin1CodesASCII.txt
+"""
+import argparse
+import io
+import os
+import struct
+import sys
+
+import gazetteer
+
+
+# Columns of the GeoNames dump.
+NAME = 1
+ASCII_NAME = 2
+ALTERNATE_NAMES = 3
+LATITUDE = 4
+LONGITUDE = 5
+COUNTRY = 8
+ADMIN1 = 10
+POPULATION = 14
+
+
+def admin1_names(path):
+    """ Read region names from admin1CodesASCII.txt, by "CC.code". """
+    names = {}
+    with io.open(path, encoding="utf-8") as f:
+        for line in f:
+            fields = line.rstrip(u"\n").split(u"\t")
+            if len(fields) >= 2:
+                names[fields[0]] = fields[1]
+    return names
+
+
+def geonames(path, regions, alternates):
+    """ Read places from a GeoNames dump. Yields (display name, lat, lng,
+    population, names to index).
+    """
+    with io.open(path, encoding="utf-8") as f:
+        for line in f:
+            fields = line.rstrip(u"\n").split(u"\t")
+            if len(fields) <= POPULATION:
+                continue
+            country = fields[COUNTRY]
+            region = regions.get(u"%s.%s" % (country, fields[ADMIN1]))
+            display = u", ".join(part for part
+                    in (fields[NAME], region, country) if part)
+            names = set([fields[NAME], fields[ASCII_NAME]])
+            if alternates:
+                names.update(name for name
+                        in fields[ALTERNATE_NAMES].split(u",") if name)
+            yield (display, float(fields[LATITUDE]), float(fields[LONGITUDE]),
+                    int(fields[POPULATION] or 0), names)
+
+
+def build(places, path):
+    """ Write a gazetteer for gazetteer.Gazetteer.
+
+    places (iterable): (display name, lat, lng, population, names to index)
+        for each place.
+    path (str): where to write the gazetteer.
+
+    Returns the number of places written.
+    """
+    # Most populous first, so ties in the indexes go to bigger places.
+    places = sorted(places, key=lambda place: -place[3])
+    names = []
+    records = []
+    prefixes = set()
+    postings = {}
+    offset = 0
+    for index, (display, lat, lng, population, indexed) in enumerate(places):
+        encoded = display.encode("utf-8")
+        records.append(gazetteer.PLACE.pack(
+                int(round(lat * gazetteer.SCALE)),
+                int(round(lng * gazetteer.SCALE)),
+                min(population, 0xffffffff), offset, len(encoded)))
+        names.append(encoded)
+        offset += len(encoded)
+        for name in indexed:
+            name = gazetteer.normalize(name)
+            if not name:
+                continue
+            prefixes.add((gazetteer.key(name), index))
+            for gram in gazetteer.trigrams(name):
+                postings.setdefault(gram, set()).add(index)
+
+    grams = sorted(postings)
+    with open(path, "wb") as f:
+        f.write(gazetteer.HEADER.pack(gazetteer.MAGIC, gazetteer.VERSION,
+                len(records), len(prefixes), len(grams),
+                sum(len(postings[gram]) for gram in grams)))
+        for record in records:
+            f.write(record)
+        for prefix, index in sorted(prefixes):
+            f.write(gazetteer.PREFIX_ENTRY.pack(prefix, index))
+        start = 0
+        for gram in grams:
+            f.write(gazetteer.TRIGRAM_ENTRY.pack(gram, start,
+                    len(postings[gram])))
+            start += len(postings[gram])
+        for gram in grams:
+            indexes = sorted(postings[gram])
+            f.write(struct.pack(">%dI" % len(indexes), *indexes))
+        for name in names:
+            f.write(name)
+    return len(records)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+            description="Build the gazetteer for geocoding place names.")
+    parser.add_argument("dump", help="GeoNames dump, such as cities15000.txt")
+    parser.add_argument("--admin1", help="GeoNames admin1CodesASCII.txt")
+    parser.add_argument("--alternate-names", action="store_true",
+            help="also index each place's alternate names")
+    parser.add_argument("--output", default=gazetteer.DATA_PATH)
+    args = parser.parse_args(argv)
+
+    regions = admin1_names(args.admin1) if args.admin1 else {}
+    directory = os.path.dirname(args.output)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    places = build(geonames(args.dump, regions, args.alternate_names),
+            args.output)
+    print "wrote %d places to %s" % (places, args.output)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,195 @@
+""" Build the coastline and border dataset that maprender.py draws maps from.
+
+Takes line or polygon GeoJSON, such as Natural Earth's 1:50m coastlines and
+land boundary lines, simplifies the lines for the map's zoom level and
+splits them into tiles:
+
+    python buildmap.py --coast ne_50m_coastline.geojson \\
+            --border ne_50m_admin_0_boundary_lines_land.geojson
+"""
+import argparse
+import json
+import math
+import os
+import struct
+import sys
+
+import maprender
+
+
+# Default size of a tile, in degrees. A map spans about 1.3 degrees of
+# longitude, so it needs at most four tiles.
+TILE_SIZE = 2.0
+
+# Default simplification tolerance, in degrees: about a pixel at the map's
+# zoom.
+TOLERANCE = 0.005
+
+
+def geojson_lines(path):
+    """ Get every line in a GeoJSON file as a list of (lon, lat) points.
+    Polygons count as their rings.
+    """
+    with open(path) as f:
+        document = json.load(f)
+    features = document.get("features", [document])
+    for feature in features:
+        geometry = feature.get("geometry", feature)
+        kind = geometry.get("type")
+        coordinates = geometry.get("coordinates") or []
+        if kind == "LineString":
+            parts = [coordinates]
+        elif kind in ("MultiLineString", "Polygon"):
+            parts = coordinates
+        elif kind == "MultiPolygon":
+            parts = [ring for polygon in coordinates for ring in polygon]
+        else:
+            parts = []
+        for part in parts:
+            yield [(float(point[0]), float(point[1])) for point in part]
+
+
+def simplify(points, tolerance):
+    """ Drop points that are closer than `tolerance` to the line through
+    their neighbours (Douglas-Peucker).
+    """
+    if len(points) < 3:
+        return points
+    keep = [False] * len(points)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        (x0, y0), (x1, y1) = points[first], points[last]
+        length = math.hypot(x1 - x0, y1 - y0)
+        farthest, index = 0.0, None
+        for i in range(first + 1, last):
+            x, y = points[i]
+            if length:
+                d = abs((x1 - x0) * (y0 - y) - (x0 - x) * (y1 - y0)) / length
+            else:
+                d = math.hypot(x - x0, y - y0)
+            if d > farthest:
+                farthest, index = d, i
+        if index is not None and farthest > tolerance:
+            keep[index] = True
+            stack.append((first, index))
+            stack.append((index, last))
+    return [point for point, kept in zip(points, keep) if kept]
+
+
+def segments(points):
+    """ Get a line's segments as ((x0, y0), (x1, y1)). A segment that
+    crosses the antimeridian, such as from 179 to -179 degrees, is cut in
+    two where it crosses, so neither piece spans the whole map.
+    """
+    for (x0, y0), (x1, y1) in zip(points, points[1:]):
+        if abs(x1 - x0) <= 180.0:
+            yield (x0, y0), (x1, y1)
+            continue
+        edge = 180.0 if x0 > x1 else -180.0
+        # Where it crosses, going the short way round.
+        span = x1 - x0 + 2 * edge
+        y = y0 + (y1 - y0) * (edge - x0) / span
+        yield (x0, y0), (edge, y)
+        yield (-edge, y), (x1, y1)
+
+
+def split(points, tile_size, columns, rows):
+    """ Split a line into runs of consecutive segments for each tile they
+    cross. Yields ((column, row), points).
+    """
+    runs = {}
+    for (x0, y0), (x1, y1) in segments(points):
+        # Every tile the segment's bounding box touches.
+        c0 = int((min(x0, x1) + 180.0) // tile_size)
+        c1 = int((max(x0, x1) + 180.0) // tile_size)
+        r0 = int((min(y0, y1) + 90.0) // tile_size)
+        r1 = int((max(y0, y1) + 90.0) // tile_size)
+        for column in range(max(0, c0), min(columns - 1, c1) + 1):
+            for row in range(max(0, r0), min(rows - 1, r1) + 1):
+                run = runs.get((column, row))
+                if run is not None and run[-1] == (x0, y0):
+                    run.append((x1, y1))
+                else:
+                    if run is not None:
+                        yield (column, row), run
+                    runs[(column, row)] = [(x0, y0), (x1, y1)]
+    for tile, run in runs.items():
+        yield tile, run
+
+
+def build(lines, path, tile_size=TILE_SIZE, tolerance=TOLERANCE, ):
+    """ Write a dataset for maprender.MapData.
+
+    lines (iterable): (kind, points) for each line, where kind is
+        maprender.COAST or maprender.BORDER and points are (lon, lat).
+    path (str): where to write the dataset.
+
+    Returns the number of points written.
+    """
+    columns = int(math.ceil(360.0 / tile_size))
+    rows = int(math.ceil(180.0 / tile_size))
+    tiles = {}
+    total = 0
+    for kind, points in lines:
+        points = simplify(points, tolerance)
+        for tile, run in split(points, tile_size, columns, rows):
+            # Point counts have to fit in the record.
+            for start in range(0, len(run) - 1, 0xfffe):
+                part = run[start:start + 0xffff]
+                values = []
+                for lon, lat in part:
+                    values.append(int(round(lon * maprender.SCALE)))
+                    values.append(int(round(lat * maprender.SCALE)))
+                tiles.setdefault(tile, []).append(
+                        maprender.RECORD.pack(kind, len(part)) +
+                        struct.pack(">%di" % len(values), *values))
+                total += len(part)
+
+    with open(path, "wb") as f:
+        f.write(maprender.HEADER.pack(maprender.MAGIC, maprender.VERSION,
+                columns, rows, tile_size))
+        offset = maprender.HEADER.size + maprender.INDEX_ENTRY.size * columns * rows
+        data = []
+        for row in range(rows):
+            for column in range(columns):
+                tile = "".join(tiles.get((column, row), []))
+                f.write(maprender.INDEX_ENTRY.pack(offset, len(tile)))
+                data.append(tile)
+                offset += len(tile)
+        for tile in data:
+            f.write(tile)
+    return total
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+            description="Build the dataset for drawing epicenter maps.")
+    parser.add_argument("--coast", action="append", default=[],
+            help="GeoJSON file of coastlines")
+    parser.add_argument("--border", action="append", default=[],
+            help="GeoJSON file of borders")
+    parser.add_argument("--output", default=maprender.DATA_PATH)
+    parser.add_argument("--tile-size", type=float, default=TILE_SIZE,
+            help="size of a tile, in degrees")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE,
+            help="simplification tolerance, in degrees")
+    args = parser.parse_args(argv)
+
+    def lines():
+        for kind, paths in ((maprender.COAST, args.coast),
+                (maprender.BORDER, args.border)):
+            for path in paths:
+                for points in geojson_lines(path):
+                    yield kind, points
+
+    directory = os.path.dirname(args.output)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    points = build(lines(), args.output, args.tile_size, args.tolerance)
+    print "wrote %d points to %s" % (points, args.output)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
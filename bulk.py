@@ -0,0 +1,198 @@
+import csv
+import json
+import math
+
+import google.appengine.api.datastore_errors
+import google.appengine.ext.ndb
+
+import util
+import models
+import feed
+import gazetteer
+
+
+# Locations of interest stored per datastore round trip.
+BATCH_SIZE = 500
+
+# Most row errors reported back for one import.
+MAX_ERRORS = 100
+
+# Columns of the CSV format, for both import and export.
+CSV_COLUMNS = ["description", "lat", "lng", "radius"]
+
+
+# Errors that mean a row doesn't make sense, rather than the whole file.
+ROW_ERRORS = (TypeError, ValueError,
+        google.appengine.api.datastore_errors.BadValueError)
+
+
+def number(value, name):
+    """ Read a number from a row. Raises ValueError if it isn't one, or if
+    it's infinite or NaN.
+    """
+    value = float(value)
+    if math.isinf(value) or math.isnan(value):
+        raise ValueError("%s must be a finite number" % name)
+    return value
+
+
+def location(owner, description, lat, lng, radius=None, ):
+    """ Validate one row of an import and make a location of interest from it.
+    Raises one of ROW_ERRORS if the row doesn't make sense.
+    """
+    if isinstance(description, str):
+        description = description.decode("utf-8")
+    lat, lng = number(lat, "lat"), number(lng, "lng")
+    if not -90.0 <= lat <= 90.0 or not -180.0 <= lng <= 180.0:
+        raise ValueError("coordinates out of range")
+    if radius in (None, ""):
+        radius = models.DEFAULT_RADIUS
+    radius = number(radius, "radius")
+    if radius <= 0.0:
+        raise ValueError("radius must be positive")
+    return models.LocationOfInterest(
+            owner=owner,
+            description=description or u"",
+            location=google.appengine.ext.ndb.GeoPt(lat, lng),
+            radius=radius)
+
+
+def geocoded(rows, batch_size=BATCH_SIZE, ):
+    """ Fill in the coordinates of rows that only have a description, from
+    the gazetteer, a batch at a time. Rows it can't find are left as they
+    are, and fail validation.
+    """
+    def fill(batch):
+        missing = [row for row in batch
+                if row[0] and row[1] in (None, "") and row[2] in (None, "")]
+        for row, place in zip(missing,
+                gazetteer.geocode_all([row[0] for row in missing])):
+            if place is not None:
+                row[1], row[2] = place["lat"], place["lng"]
+        return batch
+
+    batch = []
+    broken = None
+    try:
+        for row in rows:
+            batch.append(list(row))
+            if len(batch) >= batch_size:
+                for row in fill(batch):
+                    yield row
+                batch = []
+    except (csv.Error, ValueError) as e:
+        # The rows before the file turned out to be broken still count.
+        broken = e
+    for row in fill(batch):
+        yield row
+    if broken is not None:
+        raise broken
+
+
+def csv_rows(stream):
+    """ Read (description, lat, lng, radius) rows from a CSV file, skipping
+    the header row if there is one. The fields are left as UTF-8 for
+    location() to decode, so a row that isn't UTF-8 fails on its own.
+    """
+    for i, row in enumerate(csv.reader(stream)):
+        if not row or (i == 0 and row[0].strip().lower() == "description"):
+            continue
+        yield row + [None] * (len(CSV_COLUMNS) - len(row))
+
+
+def geojson_rows(stream):
+    """ Read (description, lat, lng, radius) rows from the Point features of
+    a GeoJSON FeatureCollection, one feature at a time. Features without a
+    geometry have no coordinates.
+    """
+    def row(feature):
+        properties = feature.get(u"properties") or {}
+        description = (properties.get(u"description") or
+                properties.get(u"name"))
+        coordinates = (feature.get(u"geometry") or {}).get(u"coordinates")
+        if not coordinates or len(coordinates) < 2:
+            return [description, None, None, properties.get(u"radius")]
+        return [description, coordinates[1], coordinates[0],
+                properties.get(u"radius")]
+    return feed.FeedReader(stream, row)
+
+
+class BulkLocationHandler (util.TemplatingBaseHandler):
+    """ Request handler for importing and exporting many locations of
+    interest at once, as CSV or GeoJSON.
+    """
+
+    @util.oauth_decorator.oauth_aware
+    def post(self):
+        """ Import locations of interest from an uploaded file, or from the
+        request body. The format is given by the "format" parameter, and is
+        "csv" unless it's "geojson".
+        """
+        if not util.oauth_decorator.has_credentials():
+            self.error(401)
+            return
+        owner = models.User.info().get("id")
+
+        upload = self.request.POST.get("file")
+        stream = getattr(upload, "file", None) or self.request.body_file
+        if self.request.get("format") == "geojson":
+            rows = geojson_rows(stream)
+        else:
+            rows = csv_rows(stream)
+
+        # Validate the rows as they're read, and store them in batches.
+        # Rows without coordinates are looked up by their description.
+        errors = []
+        def valid(rows):
+            try:
+                for number, row in enumerate(geocoded(rows), 1):
+                    try:
+                        yield location(owner, *row[:len(CSV_COLUMNS)])
+                    except ROW_ERRORS as e:
+                        if len(errors) < MAX_ERRORS:
+                            errors.append({"row": number, "error": str(e)})
+            except (csv.Error, ValueError) as e:
+                # The file itself is broken, not just a row. The rows before
+                # it are still stored.
+                errors.append({"row": None, "error": str(e)})
+        added = len(models.LocationOfInterest.put_all(valid(rows),
+                BATCH_SIZE))
+
+        self.response.headers["Content-Type"] = "application/json"
+        self.response.out.write(json.dumps({"added": added, "errors": errors}))
+
+    @util.oauth_decorator.oauth_aware
+    def get(self):
+        """ Export the current user's locations of interest, as CSV unless the
+        "format" parameter is "geojson". The locations are read a batch at a
+        time, but webapp2 buffers the whole response before sending it.
+        """
+        if not util.oauth_decorator.has_credentials():
+            self.error(401)
+            return
+        owner = models.User.info().get("id")
+        lois = models.LocationOfInterest.query_user(owner).iter(
+                batch_size=BATCH_SIZE)
+        out = self.response.out
+
+        if self.request.get("format") == "geojson":
+            self.response.headers["Content-Type"] = "application/geo+json"
+            out.write('{"type": "FeatureCollection", "features": [')
+            for i, loi in enumerate(lois):
+                if i:
+                    out.write(",")
+                out.write(json.dumps({
+                        "type": "Feature",
+                        "geometry": {"type": "Point", "coordinates":
+                                [loi.location.lon, loi.location.lat]},
+                        "properties": {"description": loi.description,
+                                "radius": loi.radius},
+                }))
+            out.write("]}")
+        else:
+            self.response.headers["Content-Type"] = "text/csv"
+            writer = csv.writer(out)
+            writer.writerow(CSV_COLUMNS)
+            for loi in lois:
+                writer.writerow([(loi.description or u"").encode("utf-8"),
+                        loi.location.lat, loi.location.lon, loi.radius])
@@ -20,16 +20,21 @@ class DashboardHandler (util.TemplatingBaseHandler):
         except models.CredentialsException as e:
             self.redirect(e.authorization_url)
 
-        #if not models.User.get_by_id(user_id):
-        #    models.User(user_id=user_id).put()
-        result = models.User.query(models.User.user_id == user_id).get()
-        if result is None:
-            models.User(user_id=user_id).put()
+        models.User.lookup(user_id)
 
-        oauth2client.appengine.StorageByKeyName(
+        # Only store the credentials if they've changed, so that most
+        # dashboard loads don't write anything.
+        storage = oauth2client.appengine.StorageByKeyName(
                 oauth2client.appengine.CredentialsModel,
                 user_id,
-                "credentials").put(util.oauth_decorator.credentials)
+                "credentials")
+        credentials = util.oauth_decorator.credentials
+        stored = storage.get()
+        if (stored is None or
+                stored.access_token != credentials.access_token or
+                stored.refresh_token != credentials.refresh_token or
+                stored.token_expiry != credentials.token_expiry):
+            storage.put(credentials)
 
         # Get the locations in which the user is interested.
         locs = [{"key": loc.key.urlsafe(), "description": loc.description}
@@ -0,0 +1,148 @@
+""" In-memory stand-ins for the Mirror API and the Static Maps API, for
+running the notification pipeline offline.
+"""
+import itertools
+import threading
+import time
+
+
+class FakeRequest (object):
+    """ An API request that runs a function when it's executed. """
+
+    def __init__(self, mirror, run, media_body=None, ):
+        self.mirror = mirror
+        self.run = run
+        self.media_body = media_body
+
+    def execute(self):
+        self.mirror.wait()
+        return self.run()
+
+
+class FakeBatch (object):
+    """ A batch of FakeRequests, executed in one (fake) round trip. Like the
+    real batch endpoint, it doesn't take requests with media uploads.
+    """
+
+    def __init__(self, mirror, callback=None, ):
+        self.mirror = mirror
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, callback=None, request_id=None, ):
+        if request.media_body is not None:
+            raise ValueError("media uploads can't be batched")
+        self.requests.append((request, callback or self.callback, request_id))
+
+    def execute(self):
+        self.mirror.wait()
+        for request, callback, request_id in self.requests:
+            try:
+                response, exception = request.run(), None
+            except Exception as e:
+                response, exception = None, e
+            if callback is not None:
+                callback(request_id, response, exception)
+        self.mirror.lose_response()
+
+
+class FakeTimeline (object):
+    """ The timeline collection of a FakeMirror. """
+
+    def __init__(self, mirror, ):
+        self.mirror = mirror
+
+    def insert(self, body, media_body=None, ):
+        def run():
+            return self.mirror.store(dict(body), media_body)
+        return FakeRequest(self.mirror, run, media_body)
+
+    def patch(self, id, body, ):
+        def run():
+            return self.mirror.change(id, body, None)
+        return FakeRequest(self.mirror, run)
+
+    def update(self, id, body, media_body=None, ):
+        def run():
+            return self.mirror.change(id, body, media_body)
+        return FakeRequest(self.mirror, run, media_body)
+
+
+class FakeMirror (object):
+    """ Stand-in for a Mirror API service connection that records every
+    timeline item instead of sending it anywhere.
+
+    latency (float): seconds each round trip takes.
+    lost_batches (int): how many batches fail as a whole after their requests
+        have gone through, as if the response were lost.
+    """
+
+    _ids = itertools.count(1)
+
+    def __init__(self, latency=0.0, lost_batches=0, ):
+        self.latency = latency
+        self.lost_batches = lost_batches
+        self.items = {}
+        self.round_trips = 0
+        self.uploads = 0
+        self._lock = threading.Lock()
+
+    def timeline(self):
+        return FakeTimeline(self)
+
+    def new_batch_http_request(self, callback=None, ):
+        return FakeBatch(self, callback)
+
+    def wait(self):
+        with self._lock:
+            self.round_trips += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def lose_response(self):
+        """ Fail a batch that has been executed, if any more are to fail. """
+        with self._lock:
+            lost = self.lost_batches > 0
+            self.lost_batches -= lost
+        if lost:
+            raise IOError("batch response lost")
+
+    def store(self, body, media_body):
+        with self._lock:
+            body["id"] = str(next(self._ids))
+            self.items[body["id"]] = body
+            if media_body is not None:
+                self.uploads += 1
+        return body
+
+    def change(self, id, body, media_body):
+        with self._lock:
+            item = self.items[id]
+            item.update(body)
+            if media_body is not None:
+                self.uploads += 1
+        return item
+
+
+class FakeStaticMaps (object):
+    """ Stand-in for downloading images from the Static Maps API, for
+    mapcache.MapImageCache.
+
+    latency (float): seconds each download takes.
+    """
+
+    # Smallest valid PNG: one transparent pixel.
+    IMAGE = ("\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR\x00\x00\x00\x01\x00\x00\x00"
+            "\x01\x08\x06\x00\x00\x00\x1f\x15\xc4\x89\x00\x00\x00\rIDATx\x9cc"
+            "\xf8\x0f\x04\x00\x09\xfb\x03\xfd\xe3U\xf2\x9c\x00\x00\x00\x00IEND"
+            "\xaeB`\x82")
+
+    def __init__(self, latency=0.0, ):
+        self.latency = latency
+        self.downloads = 0
+
+    def __call__(self, url):
+        self.downloads += 1
+        if self.latency:
+            time.sleep(self.latency)
+        return self.IMAGE
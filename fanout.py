@@ -0,0 +1,118 @@
+""" Fanning work out over task queue tasks, so that no single request has to
+do all of it before its deadline.
+"""
+import collections
+import json
+
+import google.appengine.api.taskqueue
+
+import feed
+
+
+# Task queue for delivery shards. See queue.yaml.
+QUEUE_NAME = "delivery"
+
+# Seconds to wait before retrying a shard, multiplied by the attempt number.
+RETRY_DELAY = 30
+
+
+class TaskQueue (object):
+    """ Sends tasks to an App Engine push queue, which runs them in parallel
+    and retries them if they fail.
+    """
+
+    def __init__(self, name=QUEUE_NAME, ):
+        self.name = name
+
+    def add(self, url, payload, countdown=0, ):
+        """ Queue a task.
+
+        url (str): the handler that will run the task.
+        payload (dict): JSON-serializable data for the handler.
+        countdown (int): seconds to wait before running the task.
+        """
+        google.appengine.api.taskqueue.add(queue_name=self.name, url=url,
+                payload=json.dumps(payload), countdown=countdown)
+
+
+class LocalQueue (object):
+    """ Stand-in for TaskQueue that runs tasks in this process instead, for
+    running and testing the pipeline offline. Tasks added while another task
+    is running are run after it, and countdowns are ignored.
+    """
+
+    def __init__(self, handlers, ):
+        """ handlers (dict): functions taking a task's payload, by URL. """
+        self.handlers = handlers
+        self.pending = collections.deque()
+        self.completed = []
+        self._running = False
+
+    def add(self, url, payload, countdown=0, ):
+        # Go through JSON, so tasks see exactly what they would have from the
+        # real queue.
+        self.pending.append((url, json.loads(json.dumps(payload))))
+        if self._running:
+            return
+        self._running = True
+        try:
+            while self.pending:
+                url, payload = self.pending.popleft()
+                self.completed.append((url, self.handlers[url](payload)))
+        finally:
+            self._running = False
+
+
+def enqueue_shards(queue, url, quakes_by_owner, shard_size, attempt=0,
+        distances=None, claim=None, ):
+    """ Split users into shards and queue a task for each shard.
+
+    queue (TaskQueue or LocalQueue): where to send the shards.
+    url (str): the handler for the shards.
+    quakes_by_owner (dict): lists of feed.Quake records, by user ID.
+    shard_size (int): most users in one shard.
+    attempt (int): how many times these users have been tried before.
+    distances (dict): km from each user's nearest location of interest to
+        each of their earthquakes, as dicts by event ID, by user ID.
+    claim (str): the token of the delivery these users are retried for,
+        which keeps its claims on their earthquakes.
+
+    Returns the number of shards queued.
+    """
+    distances = distances or {}
+    owners = sorted(quakes_by_owner)
+    shards = 0
+    for start in range(0, len(owners), shard_size):
+        # Each shard carries only the earthquakes its users need.
+        users = []
+        quakes = {}
+        for owner in owners[start:start + shard_size]:
+            ids = [quake.id for quake in quakes_by_owner[owner]]
+            near = distances.get(owner, {})
+            users.append([owner, ids, [near.get(quake_id) for quake_id in ids]])
+            for quake in quakes_by_owner[owner]:
+                quakes[quake.id] = quake.fields()
+        payload = {"attempt": attempt, "users": users,
+                "quakes": quakes.values()}
+        if claim is not None:
+            payload["claim"] = claim
+        queue.add(url, payload, RETRY_DELAY * attempt)
+        shards += 1
+    return shards
+
+
+def unpack_shard(payload):
+    """ Get the attempt number, the feed.Quake records by user ID and the
+    distances by user ID out of a shard made by enqueue_shards.
+    """
+    quakes = dict((fields[0], feed.Quake.from_fields(fields))
+            for fields in payload["quakes"])
+    quakes_by_owner = {}
+    distances = {}
+    for user in payload["users"]:
+        owner, ids = user[:2]
+        quakes_by_owner[owner] = [quakes[quake_id] for quake_id in ids]
+        # Shards queued before distances were added don't have them.
+        if len(user) > 2:
+            distances[owner] = dict(zip(ids, user[2]))
+    return payload["attempt"], quakes_by_owner, distances
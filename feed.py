@@ -0,0 +1,247 @@
+""" Downloading the USGS earthquake feed.
+"""
+import calendar
+import datetime
+import json
+import urllib2
+
+
+# Bytes read from the feed at a time when streaming it.
+CHUNK_SIZE = 64 * 1024
+
+
+class Quake (object):
+    """ Compact record of one earthquake from the feed, holding only what the
+    notifier needs.
+
+    id (unicode): the USGS event ID.
+    lon, lat (float): the coordinates of the epicenter, in degrees.
+    depth (float): depth of the hypocenter, in kilometres.
+    mag (float): magnitude, or None if USGS hasn't determined it.
+    time (int): when the earthquake happened, in ms since the epoch.
+    place (unicode): human-readable description of the location.
+    updated (int): when USGS last revised the event, in ms since the epoch.
+    """
+    __slots__ = ("id", "lon", "lat", "depth", "mag", "time", "place",
+            "updated")
+
+    def __init__(self, id, lon, lat, depth, mag, time, place, updated=None, ):
+        self.id = id
+        self.lon = lon
+        self.lat = lat
+        self.depth = depth
+        self.mag = mag
+        self.time = time
+        self.place = place
+        self.updated = updated if updated is not None else time
+
+    @classmethod
+    def from_feature(cls, feature):
+        """ Make a record from a GeoJSON feature in the USGS feed. """
+        coordinates = feature[u"geometry"][u"coordinates"]
+        properties = feature[u"properties"]
+        mag = properties.get(u"mag")
+        return cls(feature[u"id"],
+                float(coordinates[0]),
+                float(coordinates[1]),
+                float(coordinates[2]) if len(coordinates) > 2 else 0.0,
+                float(mag) if mag is not None else None,
+                int(properties[u"time"]),
+                properties.get(u"place") or u"",
+                int(properties.get(u"updated") or properties[u"time"]))
+
+    @classmethod
+    def from_catalog_row(cls, row):
+        """ Make a record from a row of a CSV file from the USGS catalog
+        search, as a dict from csv.DictReader.
+        """
+        mag = row.get("mag")
+        return cls(row["id"].decode("utf-8"),
+                float(row["longitude"]),
+                float(row["latitude"]),
+                float(row.get("depth") or 0.0),
+                float(mag) if mag else None,
+                parse_time(row["time"]),
+                (row.get("place") or "").decode("utf-8"),
+                parse_time(row["updated"]) if row.get("updated") else None)
+
+    @classmethod
+    def from_fields(cls, fields):
+        """ Make a record from the list made by fields(). """
+        return cls(*fields)
+
+    def fields(self):
+        """ Get the record as a JSON-serializable list, in __slots__ order. """
+        return [getattr(self, name) for name in self.__slots__]
+
+    @property
+    def datetime(self):
+        """ When the earthquake happened, as a naive UTC datetime. """
+        return datetime.datetime.utcfromtimestamp(self.time / 1000)
+
+    def __repr__(self):
+        return "<Quake %s M%s (%f, %f)>" % (self.id, self.mag, self.lon,
+                self.lat)
+
+
+def parse_time(text):
+    """ Convert a UTC time from the USGS catalog, such as
+    "2014-01-31T23:53:37.000Z", to ms since the epoch.
+    """
+    seconds, _, fraction = text.rstrip("Z").partition(".")
+    parsed = datetime.datetime.strptime(seconds, "%Y-%m-%dT%H:%M:%S")
+    return (calendar.timegm(parsed.timetuple()) * 1000 +
+            int((fraction + "000")[:3]))
+
+
+def open_feed(uri, state, ):
+    """ Open the earthquake feed, unless it hasn't changed since last time.
+
+    uri (str): the URI of the GeoJSON feed.
+    state (models.FeedState): what is known about the feed from the last
+        fetch. Its ETag and Last-Modified are updated from the response, but
+        it isn't saved.
+
+    Returns a file-like response, or None if the server says the feed hasn't
+    been modified.
+    """
+    request = urllib2.Request(uri)
+    if state.etag:
+        request.add_header("If-None-Match", state.etag)
+    if state.last_modified:
+        request.add_header("If-Modified-Since", state.last_modified)
+
+    try:
+        response = urllib2.urlopen(request)
+    except urllib2.HTTPError as e:
+        if e.code == 304:
+            return None
+        raise
+
+    state.etag = response.info().getheader("ETag")
+    state.last_modified = response.info().getheader("Last-Modified")
+    return response
+
+
+class FeedReader (object):
+    """ Reads a GeoJSON FeatureCollection from a stream one feature at a
+    time, so that only one feature has to be held in memory at once no matter
+    how big the feed is.
+
+    Iterating over the reader yields each feature, converted by the given
+    function as soon as it's parsed so that the raw GeoJSON can be dropped.
+    The feed's metadata is available as .metadata once the reader has gotten
+    past it, which for USGS feeds is before the first feature.
+    """
+
+    def __init__(self, stream, convert=Quake.from_feature,
+            chunk_size=CHUNK_SIZE, ):
+        """ stream (file-like): the response to read the feed from.
+        convert (callable): turns each GeoJSON feature dict into whatever
+            the reader should yield.
+        """
+        self.stream = stream
+        self.convert = convert
+        self.chunk_size = chunk_size
+        self.metadata = None
+        self._decoder = json.JSONDecoder()
+        self._buffer = ""
+        self._pos = 0
+        self._eof = False
+        self._started = False
+
+    def header(self):
+        """ Read up to the first feature, and return the feed's metadata. """
+        if not self._started:
+            self._started = True
+            self._expect("{")
+            self._at_features = self._members()
+        return self.metadata
+
+    def __iter__(self):
+        self.header()
+        while self._at_features:
+            if self._skip() == "]":
+                self._pos += 1
+            else:
+                while True:
+                    yield self.convert(self._value())
+                    if self._expect(",]") == "]":
+                        break
+            # Carry on through whatever comes after the features.
+            self._at_features = self._expect(",}") == "," and self._members()
+
+    def _members(self):
+        """ Read the members of the top-level object until the start of the
+        features array or the end of the object. Returns True if the reader
+        stopped at the features.
+        """
+        if self._skip() == "}":
+            self._pos += 1
+            return False
+        while True:
+            key = self._value()
+            self._expect(":")
+            if key == u"features":
+                self._expect("[")
+                return True
+            value = self._value()
+            if key == u"metadata":
+                self.metadata = value
+            if self._expect(",}") == "}":
+                return False
+
+    def _fill(self):
+        """ Read another chunk from the stream. Returns False at the end. """
+        if self._eof:
+            return False
+        chunk = self.stream.read(self.chunk_size)
+        if not chunk:
+            self._eof = True
+            return False
+        # Drop everything that's already been parsed.
+        self._buffer = self._buffer[self._pos:] + chunk
+        self._pos = 0
+        return True
+
+    def _skip(self):
+        """ Skip whitespace, and return the next character without consuming
+        it.
+        """
+        while True:
+            while (self._pos < len(self._buffer) and
+                    self._buffer[self._pos] in " \t\r\n"):
+                self._pos += 1
+            if self._pos < len(self._buffer):
+                return self._buffer[self._pos]
+            if not self._fill():
+                raise ValueError("unexpected end of feed")
+
+    def _expect(self, characters):
+        """ Consume the next character, which has to be one of the given
+        ones, and return it.
+        """
+        c = self._skip()
+        if c not in characters:
+            raise ValueError("expected one of %r in feed, found %r" %
+                    (characters, c))
+        self._pos += 1
+        return c
+
+    def _value(self):
+        """ Parse the next complete JSON value. """
+        self._skip()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buffer, self._pos)
+            except ValueError:
+                # Probably cut off at the end of the buffer.
+                if self._fill():
+                    continue
+                raise
+            # A number at the very end of the buffer might continue into the
+            # next chunk.
+            if end == len(self._buffer) and self._fill():
+                continue
+            self._pos = end
+            return value
@@ -1,31 +1,94 @@
 import base64
+import cgi
 import datetime
 import httplib2
-import io
 import json
-import math
+import logging
 import random
+import time
 import urllib2
+import uuid
 
-import apiclient.discovery
-import apiclient.http
+import google.appengine.api.memcache
 import oauth2client.appengine
 import webapp2
 
 import util
 import models
+import fanout
+import feed
+import mapcache
+import maprender
+import matching
+import mirror
+import scheduler
+import services
+import stats
+import workers
 
 
 # URI for all earthquakes that occurred within the past hour.
 QUAKE_DATA_URI = "http://earthquake.usgs.gov/earthquakes/feed/v1.0/summary/all_hour.geojson"
 
-# Radius around a location of interest in which earthquakes are considered
-# interesting.
-RADIUS = 0.5 # geological degrees
+# Memcache key held by the poller backend while it's polling the feed, for
+# the /fetch cron job to stand aside.
+POLLER_LEASE_KEY = "poller-lease"
 
+# Maximum number of users to deliver cards to at the same time, within one
+# delivery shard.
+DELIVERY_CONCURRENCY = 10
 
-def dist(a, b):
-    return math.sqrt(math.pow(a[0] - b[0], 2) + math.pow(a[1] - b[1], 2))
+# Where delivery shards are sent, how many users are in each, and how many
+# times the users whose delivery failed are tried again.
+SHARD_URI = "/fetch/deliver"
+SHARD_SIZE = 50
+SHARD_RETRIES = 3
+
+# Seconds to remember that an earthquake was sent to a user. Twice the span
+# of the feed, so an earthquake can't still be in the feed once it's
+# forgotten.
+LEDGER_TTL = 2 * 3600
+
+# Seconds a delivery's claim on an earthquake lasts, if it isn't confirmed or
+# given up before then: as long as a task can run.
+CLAIM_TTL = 10 * 60
+
+# How far a revised epicenter has to move before its card gets a new map.
+MOVED_DISTANCE = 1.0 # km
+
+# Limits on the cards sent to each user and to everyone, as token buckets:
+# how many cards can go out at once, and how many a second the allowance
+# grows back by. Cards beyond a user's limit are listed on their bundle cover
+# instead of being sent on their own. The global limit is per instance.
+USER_BURST = 5
+USER_RATE = 10 / 3600.0
+QUOTA_BURST = 500
+QUOTA_RATE = 50.0
+
+# Outcomes of delivering cards to a user.
+DELIVERED = "delivered"
+SKIPPED = "skipped"
+FAILED = "failed"
+
+
+# Queue for delivery shards. Replace with local_queue() to run the whole
+# pipeline in this process.
+delivery_queue = fanout.TaskQueue()
+
+# Global limit shared by every shard delivered on this instance.
+quota = scheduler.TokenBucket(QUOTA_RATE, QUOTA_BURST)
+
+
+def local_queue(handler=None, ):
+    """ Make a queue that delivers shards right away in this process, for
+    running the pipeline offline.
+
+    handler (class): the DeliveryShardHandler (sub)class to deliver with.
+    """
+    handler = handler or DeliveryShardHandler
+    return fanout.LocalQueue({
+            SHARD_URI: lambda payload: handler().deliver_shard(payload),
+    })
 
 
 def mapurl(quake):
@@ -33,9 +96,10 @@ def mapurl(quake):
     The URI created by this function requests a static map from the Google
     Maps engine, centered around and with a marker at the epicenter of the
     given earthquake.
+
+    quake (feed.Quake): the earthquake.
     """
-    lon = float(quake[u"geometry"][u"coordinates"][0])
-    lat = float(quake[u"geometry"][u"coordinates"][1])
+    lon, lat = quake.lon, quake.lat
 
     uri = "http://maps.googleapis.com/maps/api/staticmap"
     q = {
@@ -71,47 +135,44 @@ def rfc3339format(dt):
     return dtstr + "+00:00"
 
 
-def make_bundle_cover(bundleId, cards):
+def make_bundle_cover(bundleId, cards, coalesced=(), ):
     """ Make a static cover card for a list of earthquakes.
     TODO make this prettier. Right now just make a card declaring the
     number of earthquakes in this bundle.
+
+    coalesced (list): feed.Quake records for earthquakes that don't get cards
+        of their own. They're counted and listed on the cover instead.
     """
+    html = "%d earthquakes" % (len(cards) + len(coalesced))
+    if coalesced:
+        html += "<ul>%s</ul>" % "".join("<li>M%.1f %s</li>" % (
+                quake.mag or 0.0, cgi.escape(quake.place or ""))
+                for quake in coalesced)
     return {
             "displayTime": rfc3339format(datetime.datetime.utcnow()),
-            "html": "<article><section>%d earthquakes</section></article>" % len(cards),
+            "html": "<article><section>%s</section></article>" % html,
             "menuItems": [{"action": "DELETE"}],
             "isBundleCover": True,
             "bundleId": bundleId,
     }
 
 
-def make_card(quake, bundleId=None, ):
-    """ Make a timeline card for an earthquake.
+def render_card(quake):
+    """ Render the parts of an earthquake's timeline card that are the same
+    for every user.
 
-    quake (geojson): A GeoJSON fragment representing the earthquake.
-    bundleId (str): The ID of the bundle into which this card will go.
+    quake (feed.Quake): The earthquake.
     """
-    # Get the important properties from the earthquake object.
-    lon = float(quake[u"geometry"][u"coordinates"][0])
-    lat = float(quake[u"geometry"][u"coordinates"][1])
-    mag = float(quake[u"properties"][u"mag"])
-    place = quake[u"properties"][u"place"]
-
     # Prepare the template for an earthquake notification card.
     template = util.get_template("quake.html")
-    values = {"loc": place, "mag": mag}
+    values = {"loc": quake.place, "mag": quake.mag or 0.0}
     mapuri = mapurl(quake)
 
-    # Compute the date and time of the earthquake.
-    ms_since_epoch = quake[u"properties"][u"time"]
-    sec_since_epoch = int(ms_since_epoch) / 1000
-    quake_dt = datetime.datetime.utcfromtimestamp(sec_since_epoch)
-
     # Construct the object model for the card.
     # Notice that the map image needs to be attached to the card to work
     # properly.
-    card = {
-            "displayTime": rfc3339format(quake_dt),
+    return {
+            "displayTime": rfc3339format(quake.datetime),
             "html": template.render(values),
             "attachments": [{
                     "contentType": "image/png",
@@ -119,91 +180,594 @@ def make_card(quake, bundleId=None, ):
             }],
             "menuItems": [{"action": "DELETE"}],
     }
+
+
+def make_card(quake, bundleId=None, cache=None, ):
+    """ Make a timeline card for an earthquake.
+
+    quake (feed.Quake): The earthquake.
+    bundleId (str): The ID of the bundle into which this card will go.
+    cache (dict): Cards already rendered by render_card, by earthquake ID.
+        The card is rendered and added if it isn't there.
+    """
+    rendered = cache.get(quake.id) if cache is not None else None
+    if rendered is None:
+        rendered = render_card(quake)
+        if cache is not None:
+            cache[quake.id] = rendered
+
+    # Every user gets their own copy, which shares the rendered parts.
+    card = dict(rendered)
     if bundleId is not None:
         card["bundleId"] = bundleId
         card["isBundleCover"] = False
     return card
 
 
+def moved(entry, quake):
+    """ Whether an earthquake's epicenter has moved since a card was sent for
+    it, by enough to need a new map.
+
+    entry (dict): the delivery ledger entry for the card.
+    quake (feed.Quake): the revised earthquake.
+    """
+    if entry.get("lon") is None or entry.get("lat") is None:
+        return True
+    return float(matching.haversine(entry["lon"], entry["lat"],
+            quake.lon, quake.lat)) > MOVED_DISTANCE
+
+
 def make_map(quake):
-    """ Fetch a static map of an earthquake location. """
-    try:
-        return urllib2.urlopen(mapurl(quake)).read()
-    except:
-        return ""
+    """ Draw a map of an earthquake location from the bundled coastlines, or
+    if they aren't bundled, fetch a static map. A fetched map is downloaded
+    once and shared by every card for the earthquake.
+    """
+    image = maprender.epicenter_map(quake.lon, quake.lat)
+    if image is None:
+        image = mapcache.maps.get(mapurl(quake))
+    return image
+
+
+def match_quakes(quakes, table):
+    """ Find the users interested in each of a set of earthquakes.
+
+    quakes (list): feed.Quake records.
+    table (models.LocationTable): everyone's locations of interest.
+
+    Returns the matching earthquakes as lists by user ID, the distance in km
+    from each user's nearest location to each of their earthquakes as dicts
+    by event ID by user ID, and the number of (earthquake, location) matches.
+    """
+    # Lay out the coordinates of every earthquake and every location of
+    # interest as arrays and match them all in one pass. Only users who own a
+    # matching location are ever looked at.
+    quake_indices, loi_indices = matching.match(
+            [quake.lon for quake in quakes],
+            [quake.lat for quake in quakes],
+            table.lons, table.lats, table.radii)
+    quake_indices = quake_indices.tolist()
+    loi_indices = loi_indices.tolist()
+    km = matching.haversine(
+            [quakes[qi].lon for qi in quake_indices],
+            [quakes[qi].lat for qi in quake_indices],
+            [table.lons[li] for li in loi_indices],
+            [table.lats[li] for li in loi_indices]).tolist()
+
+    # Group the earthquakes by the users who are interested in them. Several
+    # of a user's locations can be near the same earthquake, but one card is
+    # enough. Delivery needs to know how near the nearest one is, to decide
+    # which cards matter most.
+    quakes_by_owner = {}
+    distances = {}
+    for qi, li, d in sorted(zip(quake_indices, loi_indices, km)):
+        owner = table.owner(li)
+        near = distances.setdefault(owner, {})
+        if quakes[qi].id not in near:
+            quakes_by_owner.setdefault(owner, []).append(quakes[qi])
+            near[quakes[qi].id] = d
+        else:
+            near[quakes[qi].id] = min(near[quakes[qi].id], d)
+    return quakes_by_owner, distances, len(quake_indices)
 
 
 class QuakeDataFetchHandler (webapp2.RequestHandler):
+    def initialize(self, request, response):
+        super(QuakeDataFetchHandler, self).initialize(request, response)
+        self.stats = stats.PipelineStats("fetch")
+
     def get(self):
+        # The poller backend fetches the feed far more often than cron does,
+        # so while it's running there's nothing for this to add.
+        if google.appengine.api.memcache.get(POLLER_LEASE_KEY) is not None:
+            logging.info("poller is running, not fetching")
+            return
         try:
-            quake_data = json.loads(urllib2.urlopen(QUAKE_DATA_URI).read())
-            self.process(quake_data)
-        except urllib2.URLError:
-            # Fail silently. This should be noisier, but most people won't care.
-            pass
+            opened = self.open_feed()
+        except urllib2.URLError as e:
+            logging.warning("couldn't fetch earthquakes: %s", e)
+            self.stats.finish()
+            return
+        if opened is not None:
+            self.read_feed(*opened)
+
+    def poll(self):
+        """ Fetch and process the earthquake feed, if it has changed.
+        Returns True if the feed had changed. Errors fetching the feed are
+        raised.
+        """
+        opened = self.open_feed()
+        if opened is None:
+            return False
+        return self.read_feed(*opened)
+
+    def open_feed(self):
+        """ Start downloading the earthquake feed. Returns the feed's state and
+        a feed.FeedReader for it, or None if it hasn't changed since the last
+        fetch. Errors fetching the feed are raised.
+        """
+        state = models.FeedState.for_feed(QUAKE_DATA_URI)
+        with self.stats.stage("download"):
+            response = feed.open_feed(QUAKE_DATA_URI, state)
+        if response is None:
+            # Nothing has changed since the last fetch.
+            self.stats.count("download", "not_modified")
+            self.stats.finish()
+            return None
+        # Parse the earthquakes one at a time as they're downloaded,
+        # instead of holding the whole feed in memory.
+        return state, feed.FeedReader(response, feed.Quake.from_feature)
+
+    def read_feed(self, state, reader):
+        """ Process the earthquakes from a feed opened by open_feed as they're
+        parsed. Returns True if the feed had changed.
+        """
+        with self.stats.stage("parse"):
+            metadata = reader.header()
+        return self.process(self.stats.timed("parse", reader), metadata,
+                state, reader)
 
-    def process(self, quake_data):
+    def process(self, quakes, metadata=None, state=None, reader=None, ):
         """ Process a set of earthquakes.
-        quake_data (geojson): The loaded earthquake GeoJSON.
+        quakes (iterable): feed.Quake records for the earthquakes, such as a
+            feed.FeedReader.
+        metadata (dict): the feed's metadata, if it's known yet.
+        state (models.FeedState): what was seen the last time the feed was
+            fetched. Updated and saved after the earthquakes are processed.
+        reader (feed.FeedReader): where the earthquakes come from, if that
+            isn't `quakes` itself. Used to get metadata that comes after the
+            earthquakes.
+
+        Returns False if the feed hadn't been regenerated since last time.
         """
+        if state is None:
+            state = models.FeedState.for_feed(QUAKE_DATA_URI)
+
+        # Stop early if the feed hasn't been regenerated since last time.
+        # The HTTP validators might still be new, so keep them.
+        generated = (metadata or {}).get(u"generated")
+        if generated is not None and generated == state.generated:
+            self.stats.count("filter", "unchanged")
+            state.put()
+            self.stats.finish()
+            return False
+
+        # Find quakes that haven't been seen before, or that USGS has revised
+        # since. The first time the feed is fetched, there's nothing to
+        # compare against, so only take recent ones.
+        seen = state.seen_updates()
+        first_fetch = state.generated is None and not seen
         last_updated = datetime.datetime.utcnow() - datetime.timedelta(0, 1800)
-
-        # Find quakes that have occurred since the last time data was fetched.
         new_quakes = []
-        for quake in quake_data[u"features"]:
-            ms_since_epoch = quake[u"properties"][u"time"]
-            sec_since_epoch = int(ms_since_epoch) / 1000
-            quake_dt = datetime.datetime.utcfromtimestamp(sec_since_epoch)
-            if quake_dt > last_updated:
-                new_quakes.append(quake)
-        self.send_notifications_for(new_quakes)
-
-    def send_notifications_for(self, quakes):
+        feed_updates = {}
+        revised = set()
+        start = time.time()
+        parsed = self.stats.seconds("parse")
+        for quake in quakes:
+            feed_updates[quake.id] = quake.updated
+            if quake.id in seen:
+                if seen[quake.id] is None or quake.updated <= seen[quake.id]:
+                    continue
+                revised.add(quake.id)
+            elif first_fetch and quake.datetime <= last_updated:
+                continue
+            new_quakes.append(quake)
+        # Time spent parsing happens inside the loop, so take it out. The
+        # header was parsed before the loop, so its time doesn't count.
+        self.stats.add_time("filter", time.time() - start -
+                (self.stats.seconds("parse") - parsed))
+        self.stats.count("filter", "items", len(feed_updates))
+        self.stats.count("filter", "new", len(new_quakes) - len(revised))
+        self.stats.count("filter", "revised", len(revised))
+        self.send_notifications_for(new_quakes, revised)
+
+        # Remember everything in the feed. Events that have dropped out of the
+        # feed won't come back, so they don't need to be remembered. If the
+        # metadata comes after the features, a reader has it by now.
+        if metadata is None:
+            metadata = getattr(reader or quakes, "metadata", None) or {}
+        state.generated = metadata.get(u"generated")
+        state.seen = feed_updates
+        state.put()
+        self.stats.finish()
+        return True
+
+    def send_notifications_for(self, quakes, revised=(), ):
         """ Create timeline entries for a set of earthquakes.
 
-        quakes (list): A list of GeoJSON fragments representing individual
+        quakes (list): A list of feed.Quake records for individual
             earthquakes. These earthquakes may or may not be interesting to
             users.
+        revised (set): the IDs of the earthquakes that are revisions of ones
+            seen before.
+
+        Returns the number of delivery shards queued.
         """
-        for user in models.User.query():
-            # Filter the new earthquakes to find the ones that are near places
-            # that the user says are interesting.
-            quakes_to_notify = []
-            for quake in quakes:
-                lon = float(quake[u"geometry"][u"coordinates"][0])
-                lat = float(quake[u"geometry"][u"coordinates"][1])
-                quakeloc = (lon, lat)
-                for loi in models.LocationOfInterest.query(
-                        models.LocationOfInterest.owner == user.user_id):
-                    interestloc = (loi.location.lon, loi.location.lat)
-                    if dist(quakeloc, interestloc) < RADIUS:
-                        quakes_to_notify.append(quake)
-
-            if len(quakes_to_notify) == 0:
-                # The user isn't interested in any of the new earthquakes,
+        # Matching is cheap enough to do here, once, for every user.
+        with self.stats.stage("match"):
+            table = models.LocationOfInterest.snapshot()
+            quakes_by_owner, distances, matches = match_quakes(quakes, table)
+        self.stats.count("match", "quakes", len(quakes))
+        self.stats.count("match", "locations", len(table))
+        self.stats.count("match", "matches", matches)
+
+        # A revision goes to everyone who has a card for the earthquake,
+        # even if it no longer matches their locations, so the card is
+        # brought up to date.
+        revisions = [quake for quake in quakes if quake.id in revised]
+        if revisions:
+            with self.stats.stage("match"):
+                by_id = dict((quake.id, quake) for quake in revisions)
+                recipients = models.DeliveryLedger.recipients(by_id)
+                added = 0
+                for event_id, owners in recipients.items():
+                    for owner in owners:
+                        owner_quakes = quakes_by_owner.setdefault(owner, [])
+                        if all(quake.id != event_id
+                                for quake in owner_quakes):
+                            owner_quakes.append(by_id[event_id])
+                            added += 1
+            self.stats.count("match", "unmatched_revisions", added)
+
+        # Hand the users out to delivery shards, which run in parallel, each
+        # in its own request.
+        self.stats.count("match", "users", len(quakes_by_owner))
+        with self.stats.stage("enqueue"):
+            shards = fanout.enqueue_shards(delivery_queue, SHARD_URI,
+                    quakes_by_owner, SHARD_SIZE, distances=distances)
+        self.stats.count("enqueue", "shards", shards)
+        return shards
+
+
+class DeliveryShardHandler (webapp2.RequestHandler):
+    """ Task handler for delivering cards to one shard of the users who are
+    interested in a fetch's earthquakes.
+    """
+
+    def initialize(self, request, response):
+        super(DeliveryShardHandler, self).initialize(request, response)
+        self.stats = stats.PipelineStats("deliver")
+
+    def post(self):
+        self.delivering = False
+        try:
+            # The task's name stays the same when the queue retries it.
+            self.deliver_shard(json.loads(self.request.body),
+                    self.request.headers.get("X-AppEngine-TaskName"))
+        except Exception:
+            # Once cards have gone out, failing the task would have the queue
+            # run the whole shard again and send them twice. The users whose
+            # cards failed have been queued again by deliver_shard.
+            if not self.delivering:
+                raise
+            logging.exception("delivery shard failed after delivering")
+
+    def deliver_shard(self, payload, token=None, ):
+        """ Deliver cards to every user in a shard, and try again later for
+        the users whose delivery failed.
+
+        payload (dict): a shard made by fanout.enqueue_shards.
+        token (str): identifies this delivery's claims in the users' ledgers.
+            A retry of the same delivery has to have the same token. Made up
+            if it isn't given.
+        """
+        attempt, quakes_by_owner, distances = fanout.unpack_shard(payload)
+        # Retries queued by an earlier attempt keep its claims.
+        self.token = payload.get("claim") or token or uuid.uuid4().hex
+
+        # Claim the earthquakes to send each user, leaving out ones that have
+        # already been sent, by an overlapping fetch or an earlier attempt at
+        # this shard, unless USGS has revised them since. Revised ones update
+        # the card that was sent before. Ones another delivery is sending
+        # are left to it.
+        with self.stats.stage("ledger"):
+            claims = workers.run(self.claim, quakes_by_owner.items(),
+                    DELIVERY_CONCURRENCY)
+        ledgers = {}
+        self.previous = {}
+        failed = {}
+        for (owner, quakes), result, error in claims:
+            if error is not None:
+                # Nothing was claimed, so all of it can be tried again.
+                self.stats.error("ledger")
+                failed[owner] = quakes
+                del quakes_by_owner[owner]
                 continue
+            ledgers[owner], unsent, previous = result
+            self.stats.count("ledger", "duplicates", len(quakes) - len(unsent))
+            self.stats.count("ledger", "revisions", len(previous))
+            if unsent:
+                quakes_by_owner[owner] = unsent
+                self.previous[owner] = previous
+            else:
+                del quakes_by_owner[owner]
+        self.sent = {}
+
+        # Send the most important cards first, within each user's allowance
+        # and the global one. New earthquakes that don't fit are listed on
+        # the user's bundle cover instead; revisions that don't fit wait for
+        # the shard to be retried.
+        with self.stats.stage("schedule"):
+            buckets = dict((owner, scheduler.TokenBucket(USER_RATE,
+                    USER_BURST, ledgers[owner].tokens, ledgers[owner].refilled))
+                    for owner in quakes_by_owner)
+            queue = scheduler.DeliveryScheduler(quota, buckets)
+            for owner, quakes in quakes_by_owner.items():
+                near = distances.get(owner, {})
+                for quake in quakes:
+                    queue.add(owner, quake, near.get(quake.id),
+                            quake.id not in self.previous[owner])
+            send, self.coalesced, deferred = queue.drain()
+        self.stats.count("schedule", "sent", sum(map(len, send.values())))
+        self.stats.count("schedule", "coalesced",
+                sum(map(len, self.coalesced.values())))
+        self.stats.count("schedule", "deferred",
+                sum(map(len, deferred.values())))
+        # What each user's ledger is confirmed with once their cards are out.
+        self.claimed = quakes_by_owner
+        self.spent = dict((owner, len(quakes)) for owner, quakes
+                in send.items())
+        self.confirmed = set()
+        # Users with the most important cards go first.
+        jobs = send.items() + [(owner, []) for owner in self.coalesced
+                if owner not in send]
+
+        # Render each interesting earthquake's card once, for every user.
+        self.cards = {}
+        with self.stats.stage("render"):
+            for quakes in send.values():
+                for quake in quakes:
+                    if quake.id not in self.cards:
+                        self.cards[quake.id] = render_card(quake)
+        self.stats.count("render", "items", len(self.cards))
+        maps = (mapcache.maps.hits, mapcache.maps.misses, mapcache.maps.errors)
+
+        # Deliver to every user in the shard at once, so the last user
+        # doesn't have to wait for everyone before them.
+        report = {DELIVERED: 0, SKIPPED: 0, FAILED: 0}
+        for owner, quakes in deferred.items():
+            failed.setdefault(owner, []).extend(quakes)
+        self.delivering = True
+        for job, outcome, error in workers.run(self.deliver, jobs,
+                DELIVERY_CONCURRENCY):
+            if error is not None:
+                outcome = FAILED
+            if outcome == FAILED:
+                # Cards that did go through aren't sent again.
+                sent = set(self.sent.get(job[0], ()))
+                failed.setdefault(job[0], []).extend(quake for quake
+                        in job[1] + self.coalesced.get(job[0], [])
+                        if quake.id not in sent)
+            report[outcome] += 1
+        for outcome, n in report.items():
+            self.stats.count("deliver", outcome, n)
+        self.stats.cache("map", mapcache.maps.hits - maps[0],
+                mapcache.maps.misses - maps[1])
+        self.stats.error("map", mapcache.maps.errors - maps[2])
+
+        # Only the cards that failed are retried, so the others aren't sent
+        # twice. They're queued before anything else can go wrong, and keep
+        # this delivery's claims. Users with nothing left, such as when an
+        # error came after all their cards were sent, aren't retried.
+        failed = dict((owner, quakes) for owner, quakes in failed.items()
+                if quakes)
+        if failed and attempt < SHARD_RETRIES:
+            fanout.enqueue_shards(delivery_queue, SHARD_URI, failed,
+                    SHARD_SIZE, attempt + 1, distances, self.token)
+        elif failed:
+            dropped = sum(map(len, failed.values()))
+            logging.warning("giving up on %d cards for %d users after %d "
+                    "attempts", dropped, len(failed), attempt + 1)
+            self.stats.count("deliver", "dropped", dropped)
+
+        # Each user's ledger was confirmed as soon as their cards went out.
+        # Give up the claims of the users who weren't delivered to, such as
+        # when all their cards were deferred or the delivery raised.
+        with self.stats.stage("ledger"):
+            workers.run(self.settle, [owner for owner in quakes_by_owner
+                    if owner not in self.confirmed], DELIVERY_CONCURRENCY)
+        self.stats.finish()
+        return report
+
+    def claim(self, job):
+        """ Claim the earthquakes to send a user in their ledger, in a
+        transaction, so no other delivery sends them at the same time.
+
+        job (tuple): the ID of the user, and a list of the earthquakes that
+            might be sent to them.
+
+        Returns the user's ledger, a list of the earthquakes claimed, and the
+        ledger entries of the ones that revise a card already sent, by event
+        ID.
+        """
+        user_id, quakes = job
+        now = time.time()
+        claimed = {}
+        def claim(ledger):
+            unsent = []
+            previous = {}
+            busy = 0
+            for quake in quakes:
+                claimant = ledger.claimant(quake.id, now)
+                if claimant is not None and claimant != self.token:
+                    busy += 1
+                    continue
+                entry = ledger.entry(quake.id, now)
+                if entry is None:
+                    unsent.append(quake)
+                elif (entry.get("item") is not None and
+                        quake.updated > entry.get("updated")):
+                    unsent.append(quake)
+                    previous[quake.id] = entry
+            claimed.update(unsent=unsent, previous=previous, busy=busy)
+            ledger.claim([quake.id for quake in unsent], self.token,
+                    CLAIM_TTL, now)
+            return bool(unsent)
+
+        ledger = models.DeliveryLedger.update(user_id, claim)
+        self.stats.count("ledger", "claimed_elsewhere", claimed["busy"])
+        return ledger, claimed["unsent"], claimed["previous"]
+
+    def confirm(self, job):
+        """ Record the cards sent to a user in their ledger, in a transaction,
+        along with what's left of their allowance, and give up the claims on
+        the earthquakes that weren't sent.
+
+        job (tuple): the ID of the user, a list of the earthquakes claimed for
+            them, and how many cards they were sent out of their allowance.
+        """
+        user_id, quakes, spent = job
+        sent = self.sent.get(user_id, {})
+        def confirm(ledger):
+            now = time.time()
+            ledger.record(sent, LEDGER_TTL, now)
+            ledger.release([quake.id for quake in quakes], self.token)
+            if spent:
+                # Another delivery may have used some of the allowance since
+                # it was read.
+                bucket = scheduler.TokenBucket(USER_RATE, USER_BURST,
+                        ledger.tokens, ledger.refilled)
+                bucket.spend(spent)
+                ledger.tokens = bucket.tokens
+                ledger.refilled = bucket.updated
+            return True
+        models.DeliveryLedger.update(user_id, confirm)
+
+    def settle(self, user_id):
+        """ Confirm a user's ledger with what was claimed for and sent to
+        them, once. A failure is logged rather than raised, since the cards
+        it records have already gone out; raising could have them resent.
+
+        user_id (str): the ID of the user.
+        """
+        if user_id in self.confirmed:
+            return
+        self.confirmed.add(user_id)
+        try:
+            self.confirm((user_id, self.claimed.get(user_id, []),
+                    self.spent.get(user_id, 0)))
+        except Exception:
+            logging.exception("couldn't confirm the ledger of %s", user_id)
+            self.stats.error("ledger")
+
+    def deliver(self, job):
+        """ Insert cards for earthquakes into one user's timeline.
+
+        job (tuple): the ID of the user to notify, and a list of the
+            earthquakes to send the user cards for. Earthquakes the scheduler
+            coalesced for the user go on the bundle cover.
 
-            # Create a (hopefully authorized) service connection to the
-            # Mirror API, and insert cards for the earthquakes.
-            credentials = oauth2client.appengine.StorageByKeyName(
-                    oauth2client.appengine.CredentialsModel,
-                    user.user_id,
-                    "credentials").get()
-            if credentials is None:
+        Returns DELIVERED, SKIPPED if the user can't be notified, or FAILED
+        if some of the cards couldn't be inserted.
+        """
+        user_id, quakes = job
+        mirror_service = self.mirror_for(user_id)
+        if mirror_service is None:
+            self.settle(user_id)
+            return SKIPPED
+        previous = getattr(self, "previous", {}).get(user_id, {})
+        coalesced = getattr(self, "coalesced", {}).get(user_id, [])
+        responses = self.insert_quakes(mirror_service, quakes, previous,
+                coalesced)
+        quakes = quakes + coalesced
+
+        # Note which card each earthquake is on, for updating it later.
+        # Coalesced earthquakes aren't on a card of their own, so they can't
+        # be updated.
+        sent = {}
+        for quake in quakes:
+            response = responses.get(quake.id)
+            if response is None:
                 continue
-            authorized_http = credentials.authorize(httplib2.Http())
-            mirror = apiclient.discovery.build(
-                    serviceName="mirror", version="v1",
-                    http=authorized_http)
-            self.insert_quakes(mirror, quakes_to_notify)
-
-    def insert_quakes(self, mirror, quakes):
-        """ Insert cards for earthquakes into a timeline.
-
-        mirror: A service connection to the Mirror API, authorized for a user.
-        quakes (list): a list of GeoJSON representations of earthquakes.
-        bundleId (str): the ID of the 
+            before = previous.get(quake.id, {})
+            sent[quake.id] = {
+                    "updated": quake.updated,
+                    "item": response.get("id") or before.get("item"),
+                    "bundle": response.get("bundleId") or before.get("bundle"),
+                    "lon": quake.lon,
+                    "lat": quake.lat,
+            }
+        if sent:
+            self.sent[user_id] = sent
+        # Record them right away, so that if the request runs out of time
+        # before the shard is done, a retry doesn't send them again.
+        self.settle(user_id)
+
+        # Measure how long it took from USGS publishing each earthquake to
+        # its card going out.
+        now = time.time()
+        for quake in quakes:
+            if quake.id in sent and quake.updated:
+                self.stats.observe("latency", now - quake.updated / 1000.0)
+        if len(sent) < len(quakes):
+            return FAILED
+        return DELIVERED
+
+    def mirror_for(self, user_id):
+        """ Create a (hopefully authorized) service connection to the Mirror
+        API for a user, or None if the user's credentials aren't stored.
+        """
+        credentials = oauth2client.appengine.StorageByKeyName(
+                oauth2client.appengine.CredentialsModel,
+                user_id,
+                "credentials").get()
+        if credentials is None:
+            return None
+        authorized_http = credentials.authorize(httplib2.Http())
+        return services.build(
+                serviceName="mirror", version="v1",
+                http=authorized_http)
+
+    def insert_quakes(self, mirror_service, quakes, previous=None,
+            coalesced=None, ):
+        """ Insert cards for earthquakes into a timeline, or update the cards
+        already there for earthquakes that USGS has revised.
+
+        Cards without a map, the bundle cover and text-only revisions share
+        one batch. Each card with a map is sent in a request of its own,
+        since the batch endpoint doesn't take uploads, so a bundle of N
+        cards with maps takes N + 1 round trips.
+
+        mirror_service: A service connection to the Mirror API, authorized for
+            a user.
+        quakes (list): a list of feed.Quake records.
+        previous (dict): ledger entries for the earthquakes that were sent
+            before, by event ID.
+        coalesced (list): feed.Quake records for new earthquakes to list on
+            the bundle cover instead of sending cards for.
+
+        Returns the resulting timeline items, by event ID, with None for
+        earthquakes whose cards couldn't be sent. Coalesced earthquakes get
+        just the bundle ID, if the cover was sent.
         """
+        previous = previous or {}
+        coalesced = coalesced or []
+        new = [quake for quake in quakes if quake.id not in previous]
+        revised = [quake for quake in quakes if quake.id in previous]
+        cache = getattr(self, "cards", None)
+        timeline = mirror_service.timeline()
+        requests = []
+        event_ids = []
+
         # Create a bundle ID. This has no effect if there's only one card,
         # but it will cause multiple notifications from the same fetch to
         # group together.
@@ -211,23 +775,51 @@ class QuakeDataFetchHandler (webapp2.RequestHandler):
                 datetime.datetime.utcnow().isoformat() +
                 chr(random.randint(0, 127)))
 
-        # Make card object models and map image uploads for each earthquake.
-        cards = []
-        mediabodies = []
-        for quake in quakes:
-            cards.append(make_card(quake, bundleId))
-            mediabodies.append(apiclient.http.MediaIoBaseUpload(
-                    io.BytesIO(make_map(quake)),
-                    mimetype="image/png",
-                    resumable=True))
-
-        # Batch-insert the earthquake cards into the timeline.
-        timeline = mirror.timeline()
-        for item in zip(cards, mediabodies):
-            timeline.insert(body=item[0], media_body=item[1]).execute()
+        # Make card object models and map images for each new earthquake.
+        with self.stats.stage("render"):
+            cards = [make_card(quake, bundleId, cache) for quake in new]
+        with self.stats.stage("map"):
+            images = [make_map(quake) for quake in new]
+        self.stats.count("map", "items", len(images))
+        for quake, card, image in zip(new, cards, images):
+            requests.append(mirror.insert_request(timeline, card, image))
+            event_ids.append(quake.id)
 
         # If there is more than one earthquake to send in this fetch, make a
         # cover card for the bundle that says how many earthquakes there are.
-        if len(cards) > 1:
-            timeline.insert(body=make_bundle_cover(bundleId, cards)).execute()
-
+        cover = None
+        if len(cards) > 1 or coalesced:
+            cover = len(requests)
+            requests.append(mirror.insert_request(timeline,
+                    make_bundle_cover(bundleId, cards, coalesced)))
+            event_ids.append(None)
+
+        # Revised earthquakes only need their text changed, unless the
+        # epicenter moved and the map has to be replaced too.
+        for quake in revised:
+            entry = previous[quake.id]
+            with self.stats.stage("render"):
+                card = make_card(quake, entry.get("bundle"), cache)
+            if moved(entry, quake):
+                with self.stats.stage("map"):
+                    image = make_map(quake)
+                requests.append(mirror.update_request(timeline,
+                        entry["item"], card, image))
+                self.stats.count("insert", "updates")
+            else:
+                requests.append(mirror.patch_request(timeline,
+                        entry["item"], {"html": card["html"]}))
+                self.stats.count("insert", "patches")
+            event_ids.append(quake.id)
+
+        # Send everything to the timeline, in batches apart from the
+        # requests that upload a map.
+        with self.stats.stage("insert"):
+            responses = mirror.execute_batch(mirror_service, requests)
+        self.stats.count("insert", "items", len(responses))
+        self.stats.error("insert", responses.count(None))
+        results = dict((event_id, response) for event_id, response
+                in zip(event_ids, responses) if event_id is not None)
+        for quake in coalesced:
+            results[quake.id] = (responses[cover] and {"bundleId": bundleId})
+        return results
@@ -0,0 +1,268 @@
+""" Offline geocoding of place names, from a bundled gazetteer such as
+GeoNames' cities.
+
+The gazetteer (see buildgazetteer.py) is one file, memory-mapped so that
+opening it costs nothing and only the parts a search touches are read:
+
+* header: "QGAZ", format version, and the number of places, prefix index
+  entries, trigrams and trigram postings.
+* places: coordinates in millionths of a degree, population, and where the
+  display name is, ordered from most to least populous.
+* prefix index: fixed-width normalized names, sorted, each with its place.
+  Names longer than KEY_LENGTH are cut off.
+* trigram index: each trigram of the normalized names, sorted, with where
+  its postings are.
+* postings: the places each trigram occurs in.
+* names: the places' display names, UTF-8.
+"""
+import bisect
+import math
+import os
+import re
+import struct
+import threading
+import unicodedata
+
+try:
+    import mmap
+except ImportError:
+    # Not every runtime has mmap. The file is read into memory instead.
+    mmap = None
+
+
+# Where the gazetteer is bundled.
+DATA_PATH = os.path.join(os.path.dirname(__file__), "gazdata", "places.bin")
+
+# Layout of the gazetteer.
+MAGIC = "QGAZ"
+VERSION = 1
+HEADER = struct.Struct(">4sHIIII")
+PLACE = struct.Struct(">iiIIH")
+KEY_LENGTH = 16
+PREFIX_ENTRY = struct.Struct(">%dsI" % KEY_LENGTH)
+TRIGRAM_ENTRY = struct.Struct(">3sII")
+POSTING = struct.Struct(">I")
+SCALE = 1e6 # units per degree
+
+# Default number of matches returned.
+LIMIT = 10
+
+# Least trigram similarity for geocode_all to take a place whose name isn't
+# exactly the one given, so a description that isn't a place name, such as
+# "field office", isn't put at whichever place it happens to resemble.
+MIN_SIMILARITY = 0.6
+
+# Most places considered from each index for one search. Trigrams that occur
+# in more places than MAX_POSTINGS say little about the name, and are
+# skipped unless they're all there is.
+MAX_CANDIDATES = 500
+MAX_POSTINGS = 20000
+
+
+def normalize(text):
+    """ Put a place name into the form the indexes use: lowercase, without
+    accents or punctuation, and UTF-8 encoded.
+    """
+    if isinstance(text, str):
+        text = text.decode("utf-8", "replace")
+    text = unicodedata.normalize("NFKD", text)
+    text = u"".join(c for c in text if not unicodedata.combining(c))
+    text = re.sub(r"[\W_]+", u" ", text.lower(), flags=re.UNICODE).strip()
+    return text.encode("utf-8")
+
+
+def trigrams(name):
+    """ Get the set of trigrams of a normalized name, padded so that the start
+    of the name counts for more than the rest.
+    """
+    padded = "  " + name + " "
+    return set(padded[i:i + 3] for i in range(len(padded) - 2))
+
+
+def key(name):
+    """ Make the prefix index key of a normalized name. """
+    return name[:KEY_LENGTH].ljust(KEY_LENGTH, "\0")
+
+
+class Gazetteer (object):
+    """ Reader for a gazetteer made by buildgazetteer.py. Safe to use from
+    several threads at once.
+    """
+
+    def __init__(self, path, ):
+        with open(path, "rb") as f:
+            if mmap is not None:
+                self.buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                self.buffer = f.read()
+        (magic, version, self.places, self.prefixes, self.trigrams,
+                postings) = HEADER.unpack_from(self.buffer, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("%s isn't a version %d gazetteer" % (path,
+                    VERSION))
+        self._places = HEADER.size
+        self._prefixes = self._places + PLACE.size * self.places
+        self._trigrams = self._prefixes + PREFIX_ENTRY.size * self.prefixes
+        self._postings = self._trigrams + TRIGRAM_ENTRY.size * self.trigrams
+        self._names = self._postings + POSTING.size * postings
+
+    def place(self, index):
+        """ Get a place as a dict of its display name, coordinates and
+        population.
+        """
+        lat, lng, population, offset, length = PLACE.unpack_from(self.buffer,
+                self._places + PLACE.size * index)
+        start = self._names + offset
+        return {
+                "name": self.buffer[start:start + length].decode("utf-8"),
+                "lat": lat / SCALE,
+                "lng": lng / SCALE,
+                "population": population,
+        }
+
+    def _search(self, count, offset, size, width, target):
+        """ Binary search a sorted table of fixed-size entries, by the first
+        `width` bytes of each entry. Returns the first entry not less than
+        the target.
+        """
+        class Keys (object):
+            def __len__(_):
+                return count
+
+            def __getitem__(_, i):
+                start = offset + size * i
+                return self.buffer[start:start + width]
+
+        return bisect.bisect_left(Keys(), target)
+
+    def prefixed(self, name, limit=MAX_CANDIDATES, ):
+        """ Get the places that have a name starting with a normalized name,
+        most populous first within each name. Returns a list of (place,
+        whether the name is exactly that).
+        """
+        prefix = name[:KEY_LENGTH]
+        exact = key(name) if len(name) < KEY_LENGTH else None
+        i = self._search(self.prefixes, self._prefixes, PREFIX_ENTRY.size,
+                KEY_LENGTH, prefix)
+        found = []
+        while i < self.prefixes and len(found) < limit:
+            entry, index = PREFIX_ENTRY.unpack_from(self.buffer,
+                    self._prefixes + PREFIX_ENTRY.size * i)
+            if not entry.startswith(prefix):
+                break
+            found.append((index, entry == exact))
+            i += 1
+        return found
+
+    def postings(self, trigram):
+        """ Get the places with a trigram in their names. """
+        i = self._search(self.trigrams, self._trigrams, TRIGRAM_ENTRY.size, 3,
+                trigram)
+        if i == self.trigrams:
+            return ()
+        entry, offset, count = TRIGRAM_ENTRY.unpack_from(self.buffer,
+                self._trigrams + TRIGRAM_ENTRY.size * i)
+        if entry != trigram:
+            return ()
+        return struct.unpack_from(">%dI" % count, self.buffer,
+                self._postings + POSTING.size * offset)
+
+    def similar(self, grams, limit=MAX_CANDIDATES, ):
+        """ Get the places whose names share the most trigrams with a set of
+        trigrams.
+        """
+        lists = sorted((self.postings(gram) for gram in grams), key=len)
+        lists = [postings for postings in lists if postings]
+        useful = [postings for postings in lists
+                if len(postings) <= MAX_POSTINGS] or lists[:1]
+        hits = {}
+        for postings in useful:
+            for index in postings:
+                hits[index] = hits.get(index, 0) + 1
+        # Ties go to the more populous place, which has the lower index.
+        return sorted(hits, key=lambda index: (-hits[index], index))[:limit]
+
+    def search(self, query, limit=LIMIT, ):
+        """ Find the places best matching a query, such as "Tokyo" or
+        "Springfield, Illinois". Words after a comma narrow down the places
+        by their region or country.
+
+        Returns a list of places like place(), best first, each with a
+        "score", the trigram "similarity" of its name to the query's, and
+        whether the query is "exactly" one of its names.
+        """
+        name, _, qualifier = query.partition(",")
+        name = normalize(name)
+        qualifier = normalize(qualifier).split()
+        if not name:
+            return []
+        grams = trigrams(name)
+        # Any of a place's names (such as alternate names) can match the
+        # prefix index, but the trigrams are only compared to its main name.
+        prefixed = {}
+        for index, exact in self.prefixed(name):
+            prefixed[index] = prefixed.get(index, False) or exact
+        candidates = set(prefixed)
+        candidates.update(self.similar(grams))
+
+        results = []
+        for index in candidates:
+            place = self.place(index)
+            full = normalize(place["name"])
+            primary = normalize(place["name"].split(u",")[0])
+            other = trigrams(primary)
+            # Dice similarity of the trigrams, plus bonuses for the name
+            # being what was typed, or starting with it, and for the
+            # qualifier, and a little for being a bigger place.
+            similarity = 2.0 * len(grams & other) / (len(grams) + len(other))
+            exactly = primary == name or bool(prefixed.get(index))
+            score = similarity
+            if exactly:
+                score += 1.0
+            elif index in prefixed:
+                score += 0.5
+            if qualifier and set(qualifier) <= set(full.split()):
+                score += 0.5
+            score += math.log10(1 + place["population"]) / 20.0
+            place["score"] = round(score, 4)
+            place["similarity"] = round(similarity, 4)
+            place["exactly"] = exactly
+            results.append(place)
+        results.sort(key=lambda place: -place["score"])
+        return results[:limit]
+
+
+_gazetteer = None
+_gazetteer_lock = threading.Lock()
+
+
+def load(path=DATA_PATH):
+    """ Get the bundled gazetteer, opening it the first time. Returns None if
+    it isn't there.
+    """
+    global _gazetteer
+    with _gazetteer_lock:
+        if _gazetteer is None and os.path.exists(path):
+            _gazetteer = Gazetteer(path)
+        return _gazetteer
+
+
+def geocode_all(names, places=None, ):
+    """ Find the best match for each of several place names at once, looking
+    each distinct name up only once. A match has to be exactly one of the
+    place's names, or close enough to its name (see MIN_SIMILARITY).
+
+    names (list): the place names.
+    places (Gazetteer): where to look, instead of the bundled gazetteer.
+
+    Returns a list of places like Gazetteer.place(), in the same order as
+    the names, with None for names that match nothing. Every entry is None
+    if the gazetteer isn't bundled.
+    """
+    places = places or load()
+    best = {}
+    for name in set(names):
+        matches = places.search(name) if places is not None else []
+        best[name] = next((place for place in matches if place["exactly"] or
+                place["similarity"] >= MIN_SIMILARITY), None)
+    return [best[name] for name in names]
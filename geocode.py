@@ -0,0 +1,34 @@
+import json
+
+import util
+import gazetteer
+
+
+class GeocodeHandler (util.TemplatingBaseHandler):
+    """ Request handler for turning place names into coordinates, from the
+    bundled gazetteer. Returns ranked matches as JSON.
+    """
+
+    @util.oauth_decorator.oauth_aware
+    def get(self):
+        if not util.oauth_decorator.has_credentials():
+            self.error(401)
+            return
+        try:
+            limit = int(self.request.get("limit") or gazetteer.LIMIT)
+        except ValueError:
+            self.error(400)
+            return
+        # A zero or negative limit would slice off the wrong end of the
+        # results, so it's at least one, and at most the default.
+        limit = max(1, min(limit, gazetteer.LIMIT))
+
+        places = gazetteer.load()
+        if places is None:
+            # Nothing to look names up in; the dashboard falls back to the
+            # Google Maps geocoder.
+            self.error(503)
+            return
+        self.response.headers["Content-Type"] = "application/json"
+        self.response.out.write(json.dumps({"results":
+                places.search(self.request.get("q"), limit)}))
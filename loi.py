@@ -4,11 +4,12 @@ import google.appengine.ext.ndb
 
 import util
 import models
+import gazetteer
 
 
 class LocationOfInterestHandler (util.TemplatingBaseHandler):
     """ Request handler for managing a user's locations of interest.
-    Provides actions for adding and deleting locations.
+    Provides actions for adding and deleting locations, several at a time.
     """
 
     @util.oauth_decorator.oauth_aware
@@ -18,29 +19,60 @@ class LocationOfInterestHandler (util.TemplatingBaseHandler):
             self.error(401)
 
         if self.request.get("action") == "put":
-            # Try to get the coordinates.
-            lng, lat = 0.0, 0.0
+            # Try to get the coordinates. Several locations can be added at
+            # once by repeating the fields. Locations without coordinates
+            # are looked up by name in the gazetteer, all at once.
+            owner = models.User.info().get("id")
+            descriptions = self.request.get_all("loi")
+            lngs = self.request.get_all("lng")
+            lats = self.request.get_all("lat")
+            if not len(descriptions) == len(lngs) == len(lats):
+                # Fields are missing, so they can't be matched up.
+                self.error(400)
+                return
+            fields = zip(descriptions, lngs, lats)
+            places = iter(gazetteer.geocode_all([description
+                    for description, lng, lat in fields if not (lng and lat)]))
+            lois = []
             try:
-                lng = float(self.request.get("lng"))
-                lat = float(self.request.get("lat"))
+                for description, lng, lat in fields:
+                    if not (lng and lat):
+                        place = next(places)
+                        if place is None:
+                            # Not a place the gazetteer knows.
+                            self.error(400)
+                            return
+                        lng, lat = place["lng"], place["lat"]
+                    # Construct a new location of interest with the given
+                    # parameters.
+                    lois.append(models.LocationOfInterest(
+                            owner=owner,
+                            description=description,
+                            location=google.appengine.ext.ndb.GeoPt(
+                                    float(lat), float(lng))))
             except:
                 self.error(400)
                 return
 
-            # Construct a new location of interest with the given parameters.
-            loi = models.LocationOfInterest(
-                    owner=models.User.info().get("id"),
-                    description=self.request.get("loi"),
-                    location=google.appengine.ext.ndb.GeoPt(lat, lng))
-
-            # Add the location of interest.
-            key = loi.put()
+            # Add the locations of interest.
+            models.LocationOfInterest.put_all(lois)
             self.redirect("/dashboard")
 
         elif self.request.get("action") == "delete":
-            # Get the location's key and use it to delete the location.
-            google.appengine.ext.ndb.Key(
-                    urlsafe=self.request.get("key")).delete()
+            # Get the locations' keys and use them to delete the locations,
+            # as long as they belong to the current user.
+            owner = models.User.info().get("id")
+            try:
+                keys = [google.appengine.ext.ndb.Key(urlsafe=key)
+                        for key in self.request.get_all("key")]
+            except:
+                self.error(400)
+                return
+            keys = [key for key in keys
+                    if key.kind() == models.LocationOfInterest._get_kind()]
+            models.LocationOfInterest.delete_all([loi.key for loi
+                    in google.appengine.ext.ndb.get_multi(keys)
+                    if loi is not None and loi.owner == owner])
             self.redirect("/dashboard")
 
         else:
@@ -33,14 +33,22 @@ import webapp2
 * models:    Database model and user information helper.
 * dashboard: Request handler for the location-of-interest management dashboard.
 * loi:       Request handler for adding and deleting locations of interest.
+* bulk:      Request handler for importing and exporting locations of interest.
+* geocode:   Request handler for looking up place names in the gazetteer.
 * timeline:  Request handler for directly pushing (fake) quake cards.
+* admin:     Request handlers for maintenance tasks.
+* poller:    Request handler for polling the earthquake feed on a backend.
 """
 import util
 import models
 import dashboard
 import loi
+import bulk
+import geocode
 import fetch
 import timeline
+import admin
+import poller
 
 
 class MainHandler (util.TemplatingBaseHandler):
@@ -68,11 +76,12 @@ class SignoutHandler (webapp2.RequestHandler):
     @util.oauth_decorator.oauth_required
     def get(self):
         user_id = models.User.info().get("id")
-        for loi in models.LocationOfInterest.query_user(user_id):
-            loi.key.delete()
-        while models.User.get_by_id(user_id):
-            models.User.get_by_id(user_id).key.delete()
+        # Delete everything in the background while the credentials are
+        # revoked.
+        deletes = models.User.delete_account_async(user_id)
+        models.User.forget_info()
         util.oauth_decorator.credentials.revoke(util.oauth_decorator.http())
+        google.appengine.ext.ndb.Future.wait_all(deletes)
         self.redirect("/")
 
 
@@ -81,9 +90,16 @@ ROUTES = [
     ("/", MainHandler),
     ("/dashboard", dashboard.DashboardHandler),
     ("/loi", loi.LocationOfInterestHandler),
+    ("/loi/bulk", bulk.BulkLocationHandler),
+    ("/geocode", geocode.GeocodeHandler),
     ("/timeline", timeline.TimelineHandler),
     ("/fetch", fetch.QuakeDataFetchHandler),
+    (fetch.SHARD_URI, fetch.DeliveryShardHandler),
     ("/signout", SignoutHandler),
+    ("/_ah/start", poller.PollerStartHandler),
+    ("/admin/migrate_users", admin.MigrateUsersHandler),
+    ("/admin/stats", admin.StatsHandler),
+    ("/admin/expire_ledgers", admin.ExpireLedgersHandler),
     (util.oauth_decorator.callback_path, util.oauth_decorator.callback_handler()),
 ]
 
@@ -0,0 +1,161 @@
+""" Cache for static map images, so that the same map is only downloaded once
+no matter how many cards it goes on.
+"""
+import collections
+import logging
+import threading
+import time
+import urllib
+import urllib2
+import urlparse
+
+import google.appengine.api.memcache
+
+
+# Bounds on the images kept in memory on each instance.
+MAX_BYTES = 8 * 1024 * 1024
+TTL = 3600 # seconds
+
+# Prefix for map images shared between instances through memcache.
+MEMCACHE_PREFIX = "map:"
+
+
+def download(url):
+    """ Download a map image from the Static Maps API. """
+    return urllib2.urlopen(url).read()
+
+
+def normalize(url):
+    """ Put a map URL into a canonical form, so that URLs which ask for the
+    same map are cached under the same key. The query parameters are sorted,
+    since fetch.mapurl builds them in no particular order.
+    """
+    parts = urlparse.urlsplit(url)
+    query = urllib.urlencode(sorted(urlparse.parse_qsl(parts.query, True)))
+    return urlparse.urlunsplit((parts.scheme, parts.netloc.lower(),
+            parts.path, query, ""))
+
+
+class Fetching (object):
+    """ An image one thread is fetching, for the others that want it to wait
+    for.
+    """
+
+    def __init__(self, ):
+        self.done = threading.Event()
+        self.image = ""
+
+
+class MapImageCache (object):
+    """ In-memory least-recently-used cache of map images, optionally backed
+    by memcache. Images are evicted when they are older than the TTL or when
+    the cache holds more than its maximum number of bytes.
+    """
+
+    def __init__(self, max_bytes=MAX_BYTES, ttl=TTL, use_memcache=True,
+            download=download, ):
+        """ download (callable): fetches the image at a URL. """
+        self.download = download
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.use_memcache = use_memcache
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+        self._entries = collections.OrderedDict()
+        self._fetching = {}
+        self._lock = threading.Lock()
+
+    def get(self, url):
+        """ Get the map image at a URL, downloading it if it isn't cached.
+        Returns an empty string if the image can't be downloaded. When
+        several threads want the same image at once, only one fetches it
+        and the others wait for it.
+        """
+        key = normalize(url)
+        image = self._get_local(key)
+        if image is not None:
+            self._count("hits")
+            return image
+
+        with self._lock:
+            fetching = self._fetching.get(key)
+            first = fetching is None
+            if first:
+                fetching = self._fetching[key] = Fetching()
+        if not first:
+            fetching.done.wait()
+            if fetching.image:
+                self._count("hits")
+            return fetching.image
+        try:
+            fetching.image = self._fetch(url, key)
+        finally:
+            with self._lock:
+                del self._fetching[key]
+            fetching.done.set()
+        return fetching.image
+
+    def _fetch(self, url, key):
+        if self.use_memcache:
+            image = google.appengine.api.memcache.get(MEMCACHE_PREFIX + key)
+            if image is not None:
+                self._count("hits")
+                self._put_local(key, image)
+                return image
+
+        self._count("misses")
+        try:
+            image = self.download(url)
+        except Exception as e:
+            # Don't cache failures, so the next card can try again.
+            logging.warning("couldn't fetch map %s: %s", url, e)
+            self._count("errors")
+            return ""
+        self._put_local(key, image)
+        if self.use_memcache:
+            google.appengine.api.memcache.set(MEMCACHE_PREFIX + key, image,
+                    time=self.ttl)
+        return image
+
+    def clear(self):
+        """ Forget every image held on this instance. """
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def _count(self, counter):
+        # Cards are made for many users at once, in several threads.
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def _get_local(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return None
+            stored, image = entry
+            if time.time() - stored > self.ttl:
+                self.size -= len(image)
+                return None
+            # Move the image to the most-recently-used end.
+            self._entries[key] = entry
+            return image
+
+    def _put_local(self, key, image):
+        if len(image) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old[1])
+            self._entries[key] = (time.time(), image)
+            self.size += len(image)
+            while self.size > self.max_bytes:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self.size -= len(evicted)
+
+
+# Cache shared by everything on this instance that needs map images.
+maps = MapImageCache()
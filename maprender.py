@@ -0,0 +1,281 @@
+""" Drawing epicenter maps locally, from a bundled dataset of coastlines and
+borders, instead of downloading them from the Static Maps API.
+
+The dataset (see buildmap.py) is a grid of tiles, each holding the simplified
+lines that cross it:
+
+* header: "QMAP", format version, grid columns and rows, tile size (degrees).
+* index: the offset and length of each tile's data, row by row from the
+  south-west corner.
+* tiles: records of a line kind (COAST or BORDER), a point count, and the
+  points as longitude and latitude in millionths of a degree.
+
+The file is memory-mapped, so only the tiles around an epicenter are read,
+and decoded tiles are kept for the next map nearby.
+"""
+import collections
+import math
+import os
+import struct
+import threading
+import zlib
+
+try:
+    import mmap
+except ImportError:
+    # Not every runtime has mmap. The file is read into memory instead.
+    mmap = None
+
+
+# Where the dataset is bundled.
+DATA_PATH = os.path.join(os.path.dirname(__file__), "mapdata", "lines.bin")
+
+# Layout of the dataset.
+MAGIC = "QMAP"
+VERSION = 1
+HEADER = struct.Struct(">4sHHHd")
+INDEX_ENTRY = struct.Struct(">II")
+RECORD = struct.Struct(">BH")
+SCALE = 1e6 # units per degree
+
+# Kinds of lines.
+COAST = 0
+BORDER = 1
+
+# Image size and zoom, matching the Static Maps images the cards used before:
+# 120x180 at zoom 7, at twice the scale.
+WIDTH = 240
+HEIGHT = 360
+ZOOM = 7
+WORLD = 256 * 2 ** ZOOM * 2 # pixels around the equator
+
+# Most decoded tiles kept in memory.
+MAX_TILES = 256
+
+# Palette: background, coastlines, borders, marker, marker outline.
+PALETTE = [(0xf2, 0xef, 0xe9), (0x3b, 0x6e, 0xa8), (0x9a, 0x9a, 0x9a),
+        (0xd9, 0x37, 0x2b), (0xff, 0xff, 0xff)]
+LINE_COLORS = {COAST: 1, BORDER: 2}
+MARKER = 3
+OUTLINE = 4
+MARKER_RADIUS = 9
+
+
+def project(lon, lat):
+    """ Web Mercator pixel coordinates of a point, at the map's zoom. """
+    lat = max(-85.0, min(85.0, lat))
+    x = (lon + 180.0) / 360.0 * WORLD
+    y = (WORLD / 2.0 - WORLD / (2 * math.pi) *
+            math.log(math.tan(math.pi / 4 + math.radians(lat) / 2)))
+    return x, y
+
+
+def unproject(x, y):
+    """ Longitude and latitude of Web Mercator pixel coordinates. """
+    lon = x / WORLD * 360.0 - 180.0
+    lat = math.degrees(2 * math.atan(math.exp(
+            (WORLD / 2.0 - y) * 2 * math.pi / WORLD)) - math.pi / 2)
+    return lon, lat
+
+
+class MapData (object):
+    """ Reader for a coastline and border dataset made by buildmap.py. """
+
+    def __init__(self, path, ):
+        with open(path, "rb") as f:
+            if mmap is not None:
+                self.buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                self.buffer = f.read()
+        magic, version, self.columns, self.rows, self.tile_size = \
+                HEADER.unpack_from(self.buffer, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("%s isn't a version %d map dataset" % (path,
+                    VERSION))
+        self._tiles = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def tile(self, column, row):
+        """ Get the lines crossing a tile, as a list of (kind, points) where
+        points is a flat list of longitudes and latitudes.
+        """
+        key = (column, row)
+        with self._lock:
+            lines = self._tiles.pop(key, None)
+            if lines is not None:
+                self._tiles[key] = lines
+                return lines
+
+        offset, length = INDEX_ENTRY.unpack_from(self.buffer,
+                HEADER.size + INDEX_ENTRY.size * (row * self.columns + column))
+        lines = []
+        end = offset + length
+        while offset < end:
+            kind, count = RECORD.unpack_from(self.buffer, offset)
+            offset += RECORD.size
+            points = struct.unpack_from(">%di" % (2 * count), self.buffer,
+                    offset)
+            offset += 8 * count
+            lines.append((kind, [value / SCALE for value in points]))
+
+        with self._lock:
+            self._tiles[key] = lines
+            while len(self._tiles) > MAX_TILES:
+                self._tiles.popitem(last=False)
+        return lines
+
+    def lines(self, west, south, east, north):
+        """ Get the lines crossing a box, as (kind, points) like tile().
+        The box can go past 180 degrees east or west.
+        """
+        first_row = max(0, int(math.floor((south + 90.0) / self.tile_size)))
+        last_row = min(self.rows - 1,
+                int(math.floor((north + 90.0) / self.tile_size)))
+        first_column = int(math.floor((west + 180.0) / self.tile_size))
+        last_column = int(math.floor((east + 180.0) / self.tile_size))
+        for column in range(first_column, last_column + 1):
+            for row in range(first_row, last_row + 1):
+                for line in self.tile(column % self.columns, row):
+                    yield line
+
+
+def clip(x0, y0, x1, y1, width, height):
+    """ Clip a line segment to an image (Liang-Barsky). Returns the clipped
+    end points, or None if none of the segment is in the image.
+    """
+    t0, t1 = 0.0, 1.0
+    dx, dy = x1 - x0, y1 - y0
+    for p, q in ((-dx, x0), (dx, width - 1 - x0), (-dy, y0),
+            (dy, height - 1 - y0)):
+        if p == 0:
+            if q < 0:
+                return None
+            continue
+        t = q / float(p)
+        if p < 0:
+            if t > t1:
+                return None
+            t0 = max(t0, t)
+        else:
+            if t < t0:
+                return None
+            t1 = min(t1, t)
+    return (x0 + t0 * dx, y0 + t0 * dy, x0 + t1 * dx, y0 + t1 * dy)
+
+
+def draw_line(pixels, x0, y0, x1, y1, color):
+    """ Draw a two pixel wide line (Bresenham) into a WIDTH by HEIGHT image of
+    palette indices.
+    """
+    segment = clip(x0, y0, x1, y1, WIDTH, HEIGHT)
+    if segment is None:
+        return
+    x0, y0, x1, y1 = [int(round(value)) for value in segment]
+    dx, dy = abs(x1 - x0), -abs(y1 - y0)
+    sx = 1 if x0 < x1 else -1
+    sy = 1 if y0 < y1 else -1
+    error = dx + dy
+    while True:
+        pixels[y0 * WIDTH + x0] = color
+        # Thicken away from the image edge.
+        if abs(dx) >= abs(dy):
+            pixels[(y0 + 1 if y0 + 1 < HEIGHT else y0 - 1) * WIDTH + x0] = color
+        else:
+            pixels[y0 * WIDTH + (x0 + 1 if x0 + 1 < WIDTH else x0 - 1)] = color
+        if x0 == x1 and y0 == y1:
+            break
+        e2 = 2 * error
+        if e2 >= dy:
+            error += dy
+            x0 += sx
+        if e2 <= dx:
+            error += dx
+            y0 += sy
+
+
+def draw_marker(pixels, cx, cy):
+    """ Draw the epicenter marker: a dot with an outline. """
+    outer = (MARKER_RADIUS + 2) ** 2
+    inner = MARKER_RADIUS ** 2
+    for y in range(max(0, cy - MARKER_RADIUS - 2),
+            min(HEIGHT, cy + MARKER_RADIUS + 3)):
+        for x in range(max(0, cx - MARKER_RADIUS - 2),
+                min(WIDTH, cx + MARKER_RADIUS + 3)):
+            d = (x - cx) ** 2 + (y - cy) ** 2
+            if d <= inner:
+                pixels[y * WIDTH + x] = MARKER
+            elif d <= outer:
+                pixels[y * WIDTH + x] = OUTLINE
+
+
+def encode_png(pixels, width, height, palette):
+    """ Encode an image of palette indices as an 8-bit paletted PNG. """
+    def chunk(kind, data):
+        return (struct.pack(">I", len(data)) + kind + data +
+                struct.pack(">I", zlib.crc32(kind + data) & 0xffffffff))
+
+    raw = bytearray()
+    for y in range(height):
+        # Each row starts with its filter type, none.
+        raw.append(0)
+        raw.extend(pixels[y * width:(y + 1) * width])
+    return ("\x89PNG\r\n\x1a\n" +
+            chunk("IHDR", struct.pack(">IIBBBBB", width, height, 8, 3, 0, 0, 0)) +
+            chunk("PLTE", "".join(struct.pack("BBB", *color)
+                    for color in palette)) +
+            chunk("IDAT", zlib.compress(str(raw), 6)) +
+            chunk("IEND", ""))
+
+
+def render(data, lon, lat):
+    """ Draw a map centered on an epicenter, as a PNG.
+
+    data (MapData): the coastlines and borders to draw.
+    lon, lat (float): the epicenter.
+    """
+    cx, cy = project(lon, lat)
+    left, top = cx - WIDTH / 2.0, cy - HEIGHT / 2.0
+    west, north = unproject(left, top)
+    east, south = unproject(left + WIDTH, top + HEIGHT)
+    pixels = bytearray(WIDTH * HEIGHT)
+
+    for kind, points in data.lines(west, south, east, north):
+        color = LINE_COLORS.get(kind, 1)
+        previous = None
+        for i in range(0, len(points), 2):
+            x, y = project(points[i], points[i + 1])
+            # Lines from across 180 degrees are moved next to the epicenter.
+            x += round((cx - x) / WORLD) * WORLD
+            x, y = x - left, y - top
+            if previous is not None:
+                draw_line(pixels, previous[0], previous[1], x, y, color)
+            previous = (x, y)
+
+    draw_marker(pixels, WIDTH // 2, HEIGHT // 2)
+    return encode_png(pixels, WIDTH, HEIGHT, PALETTE)
+
+
+_data = None
+_data_lock = threading.Lock()
+
+
+def load(path=DATA_PATH):
+    """ Get the bundled dataset, opening it the first time. Returns None if
+    it isn't there.
+    """
+    global _data
+    with _data_lock:
+        if _data is None and os.path.exists(path):
+            _data = MapData(path)
+        return _data
+
+
+def epicenter_map(lon, lat):
+    """ Draw a map of an epicenter from the bundled dataset. Returns None if
+    the dataset isn't bundled, so the caller can fall back to the Static Maps
+    API.
+    """
+    data = load()
+    if data is None:
+        return None
+    return render(data, lon, lat)
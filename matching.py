@@ -0,0 +1,87 @@
+""" Vectorized matching of earthquakes against locations of interest.
+"""
+import numpy
+
+
+# Mean radius of the Earth.
+EARTH_RADIUS = 6371.0088 # km
+
+# Number of earthquakes compared against the locations of interest at a time.
+CHUNK_SIZE = 256
+
+# Most (earthquake, location) pairs compared at once. Bounds the size of the
+# distance matrix and of haversine's temporaries, 8 bytes a pair each, however
+# many locations a chunk of earthquakes has in its band.
+MAX_PAIRS = 1 << 20
+
+
+def haversine(lon1, lat1, lon2, lat2):
+    """ Great-circle distance between points, in kilometres.
+    Arguments are arrays (or scalars) of degrees and broadcast against each
+    other the same way numpy arithmetic does.
+    """
+    lon1, lat1, lon2, lat2 = [numpy.radians(numpy.asarray(x, dtype=float))
+            for x in (lon1, lat1, lon2, lat2)]
+    a = (numpy.sin((lat2 - lat1) / 2.0) ** 2 +
+            numpy.cos(lat1) * numpy.cos(lat2) *
+            numpy.sin((lon2 - lon1) / 2.0) ** 2)
+    return 2.0 * EARTH_RADIUS * numpy.arcsin(numpy.sqrt(numpy.minimum(a, 1.0)))
+
+
+def match(quake_lons, quake_lats, loi_lons, loi_lats, loi_radii,
+        chunk_size=CHUNK_SIZE, max_pairs=MAX_PAIRS, ):
+    """ Find every (earthquake, location of interest) pair where the
+    earthquake is within the location's radius.
+
+    quake_lons, quake_lats (sequence): epicenter coordinates, in degrees.
+    loi_lons, loi_lats (sequence): location coordinates, in degrees.
+    loi_radii (sequence): radius around each location, in kilometres.
+    chunk_size (int): number of earthquakes to compare at a time.
+    max_pairs (int): most pairs to compare at a time. The locations in a
+        chunk's band are split into blocks to stay within it.
+
+    Returns a pair of integer arrays (quake indices, location indices) of the
+    same length, one entry per match.
+    """
+    quake_lons = numpy.asarray(quake_lons, dtype=float)
+    quake_lats = numpy.asarray(quake_lats, dtype=float)
+    loi_lons = numpy.asarray(loi_lons, dtype=float)
+    loi_lats = numpy.asarray(loi_lats, dtype=float)
+    loi_radii = numpy.asarray(loi_radii, dtype=float)
+
+    empty = (numpy.zeros(0, dtype=int), numpy.zeros(0, dtype=int))
+    if len(quake_lons) == 0 or len(loi_lons) == 0:
+        return empty
+
+    # Sort both sides by latitude. A location can only match an earthquake
+    # if their latitudes are within the largest radius of each other, so each
+    # chunk of earthquakes only needs to look at one band of locations.
+    # Latitude degrees are the same length everywhere, unlike longitude.
+    loi_order = numpy.argsort(loi_lats)
+    sorted_lats = loi_lats[loi_order]
+    quake_order = numpy.argsort(quake_lats)
+    band = numpy.degrees(loi_radii.max() / EARTH_RADIUS)
+
+    quake_hits = []
+    loi_hits = []
+    for start in range(0, len(quake_order), chunk_size):
+        qi = quake_order[start:start + chunk_size]
+        lo = numpy.searchsorted(sorted_lats, quake_lats[qi].min() - band, "left")
+        hi = numpy.searchsorted(sorted_lats, quake_lats[qi].max() + band, "right")
+        # One row per earthquake, one column per location in the band. A
+        # chunk spread over many latitudes can have most of the locations in
+        # its band, so they're taken a block of columns at a time.
+        columns = max(1, max_pairs // len(qi))
+        for first in range(lo, hi, columns):
+            li = loi_order[first:min(hi, first + columns)]
+            distances = haversine(quake_lons[qi][:, numpy.newaxis],
+                    quake_lats[qi][:, numpy.newaxis],
+                    loi_lons[li][numpy.newaxis, :],
+                    loi_lats[li][numpy.newaxis, :])
+            rows, hits = numpy.nonzero(distances <= loi_radii[li])
+            quake_hits.append(qi[rows])
+            loi_hits.append(li[hits])
+
+    if not quake_hits:
+        return empty
+    return numpy.concatenate(quake_hits), numpy.concatenate(loi_hits)
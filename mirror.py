@@ -0,0 +1,139 @@
+""" Helpers for talking to the Mirror API in as few round trips as possible.
+
+Requests without media go in batches of up to BATCH_SIZE. The batch endpoint
+doesn't take media uploads, so a card with an attached map always costs a
+round trip of its own.
+"""
+import io
+import logging
+
+import apiclient.errors
+import apiclient.http
+
+
+# Most requests sent in one batch.
+BATCH_SIZE = 50
+
+# Times a failed request in a batch is retried before giving up on it.
+RETRIES = 2
+
+
+def media(image):
+    """ Package a PNG image for attaching to a timeline card. The images are
+    small, so it's sent in one piece rather than as a resumable upload.
+    """
+    return apiclient.http.MediaIoBaseUpload(io.BytesIO(image),
+            mimetype="image/png", resumable=False)
+
+
+def upload(make):
+    """ Mark a function made for execute_batch as making a request with a
+    media upload. The batch endpoint doesn't take media, so execute_batch
+    sends these on their own.
+    """
+    make.upload = True
+    return make
+
+
+def retriable(exception):
+    """ Whether a failed request might succeed if it's sent again. """
+    if isinstance(exception, apiclient.errors.HttpError):
+        status = int(exception.resp.status)
+        return status >= 500 or status == 429
+    return True
+
+
+def new_batch(service, callback):
+    """ Make an empty batch request for a service. """
+    if hasattr(service, "new_batch_http_request"):
+        return service.new_batch_http_request(callback=callback)
+    return apiclient.http.BatchHttpRequest(callback=callback)
+
+
+def execute_batch(service, requests, retries=RETRIES, ):
+    """ Execute API requests in batches, retrying only the ones that fail.
+    Requests with media uploads (see upload()) are executed one at a time.
+
+    service: the service connection the requests are for.
+    requests (list): callables that each make a fresh, unexecuted API request
+        object. The request has to be made again for every attempt, since an
+        executed request can't be added to another batch.
+    retries (int): times a failed request is retried.
+
+    Returns a list of responses in the same order as the requests, with None
+    for requests that failed every attempt.
+    """
+    responses = [None] * len(requests)
+    pending = range(len(requests))
+    for attempt in range(retries + 1):
+        errors = {}
+        batched = [i for i in pending
+                if not getattr(requests[i], "upload", False)]
+        for start in range(0, len(batched), BATCH_SIZE):
+            chunk = batched[start:start + BATCH_SIZE]
+            def callback(request_id, response, exception):
+                if exception is not None:
+                    errors[int(request_id)] = exception
+                else:
+                    responses[int(request_id)] = response
+
+            batch = new_batch(service, callback)
+            for i in chunk:
+                batch.add(requests[i](), request_id=str(i))
+            try:
+                batch.execute()
+            except Exception as e:
+                # The whole batch failed to go through, maybe after some of
+                # its requests had. Only the ones without a response are
+                # sent again.
+                logging.warning("batch failed: %s", e)
+                errors.update((i, e) for i in chunk if responses[i] is None)
+
+        for i in pending:
+            if getattr(requests[i], "upload", False):
+                try:
+                    responses[i] = requests[i]().execute()
+                except Exception as e:
+                    errors[i] = e
+
+        failed = []
+        for i, exception in sorted(errors.items()):
+            if retriable(exception):
+                failed.append(i)
+            else:
+                logging.warning("request %d failed: %s", i, exception)
+        if not failed:
+            break
+        pending = failed
+    else:
+        logging.warning("%d requests failed after %d retries",
+                len(failed), retries)
+    return responses
+
+
+def insert_request(timeline, card, image=None, ):
+    """ Make a function that makes a request to insert a timeline card,
+    optionally with an attached PNG image, for execute_batch. An empty image,
+    from a map that couldn't be fetched, isn't attached.
+    """
+    if not image:
+        return lambda: timeline.insert(body=card)
+    return upload(lambda: timeline.insert(body=card, media_body=media(image)))
+
+
+def patch_request(timeline, item_id, changes):
+    """ Make a function that makes a request to change some fields of a
+    timeline item, for execute_batch.
+    """
+    return lambda: timeline.patch(id=item_id, body=changes)
+
+
+def update_request(timeline, item_id, card, image):
+    """ Make a function that makes a request to replace a timeline item and
+    its attached PNG image, for execute_batch. An empty image leaves the
+    attachment as it was.
+    """
+    if not image:
+        return lambda: timeline.update(id=item_id, body=card)
+    return upload(lambda: timeline.update(id=item_id, body=card,
+            media_body=media(image)))
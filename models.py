@@ -1,9 +1,34 @@
-import apiclient.discovery
+import array
+import datetime
+import hashlib
+import threading
+import time
+
+import google.appengine.api.memcache
 import google.appengine.ext.db
 import google.appengine.ext.ndb
 import oauth2client.appengine
 
 import util
+import services
+
+
+# Default radius around a location of interest in which earthquakes are
+# considered interesting.
+DEFAULT_RADIUS = 50.0 # km
+
+# Memcache prefix and lifetime for remembered user profile information.
+USER_INFO_PREFIX = "userinfo:"
+USER_INFO_TTL = 300 # seconds
+
+# Memcache key for the number that changes whenever any location of interest
+# is written, and the number of locations loaded per datastore round trip
+# when taking a snapshot of all of them.
+LOI_GENERATION_KEY = "loi-generation"
+LOI_BATCH_SIZE = 1000
+
+# Most values in one IN filter.
+MAX_IN_VALUES = 30
 
 
 class CredentialsException (Exception):
@@ -25,18 +50,103 @@ class NoUserIdException (CredentialsException):
 
 
 class User (google.appengine.ext.ndb.Model):
+    """ NDB model class for a user who has authorized the application.
+    Keyed by the user's ID. Users stored before that was the case have
+    automatically assigned keys, and are migrated by lookup() or migrate().
+    """
     user_id = google.appengine.ext.ndb.StringProperty()
 
+    @classmethod
+    def lookup(cls, user_id):
+        """ Get a user by ID, creating them if they don't exist yet.
+
+        cls: this class (models.User).
+        user_id (string): the user's ID.
+        """
+        user = cls.get_by_id(user_id)
+        if user is None:
+            # Either a new user, or one stored under an automatic key.
+            legacy = cls.query(cls.user_id == user_id).fetch(keys_only=True)
+            user = cls(id=user_id, user_id=user_id)
+            user.put()
+            google.appengine.ext.ndb.delete_multi(legacy)
+        return user
+
+    @classmethod
+    def migrate(cls, batch_size=LOI_BATCH_SIZE):
+        """ Re-key every user stored under an automatic key by their user ID.
+        Users under an automatic key without a user ID can't be re-keyed or
+        looked up, so they're deleted. Returns the number of users migrated.
+        """
+        migrated = 0
+        legacy = []
+        orphans = []
+        for user in cls.query().iter(batch_size=batch_size):
+            if user.key.id() == user.user_id:
+                continue
+            if user.user_id:
+                legacy.append(user)
+            elif isinstance(user.key.id(), (int, long)):
+                orphans.append(user.key)
+        for start in range(0, len(orphans), batch_size):
+            google.appengine.ext.ndb.delete_multi(
+                    orphans[start:start + batch_size])
+        for start in range(0, len(legacy), batch_size):
+            batch = legacy[start:start + batch_size]
+            google.appengine.ext.ndb.put_multi([cls(id=user.user_id,
+                    user_id=user.user_id) for user in batch])
+            google.appengine.ext.ndb.delete_multi([user.key for user in batch])
+            migrated += len(batch)
+        return migrated
+
+    @classmethod
+    def delete_account_async(cls, user_id):
+        """ Delete all of a user's locations of interest, and start deleting
+        the user. Returns a list of futures for the deletes.
+
+        cls: this class (models.User).
+        user_id (string): the user's ID.
+        """
+        # Through delete_all, so the cached snapshots are marked stale once
+        # rather than for every location.
+        LocationOfInterest.delete_all(
+                LocationOfInterest.query_user(user_id).fetch(keys_only=True))
+        keys = [google.appengine.ext.ndb.Key(cls, user_id)]
+        # Users that haven't been migrated yet are under other keys.
+        keys.extend(cls.query(cls.user_id == user_id).fetch(keys_only=True))
+        return google.appengine.ext.ndb.delete_multi_async(keys)
+
+    @staticmethod
+    def info_cache_key():
+        """ Get the memcache key for the current user's profile information,
+        based on the identity of their credentials. Returns None if the
+        credentials have no token to tell them apart, so nothing is cached.
+        """
+        credentials = util.oauth_decorator.credentials
+        token = credentials.refresh_token or credentials.access_token
+        if not token:
+            return None
+        return USER_INFO_PREFIX + hashlib.sha1(token).hexdigest()
+
     @staticmethod
     def info():
-        """ Get the current user's profile information. """
+        """ Get the current user's profile information.
+        The profile is remembered for a short while, so that most requests
+        don't have to ask the Google OAuth service for it.
+        """
 
         # Fail if the user is not logged in.
         if not util.oauth_decorator.has_credentials():
             raise NotAuthorizedException(util.oauth_decorator.authorize_url())
 
+        cache_key = User.info_cache_key()
+        if cache_key is not None:
+            user_info = google.appengine.api.memcache.get(cache_key)
+            if user_info is not None:
+                return user_info
+
         # Build the OAuth service to get the current user information.
-        user_info_service = apiclient.discovery.build(
+        user_info_service = services.build(
                 serviceName="oauth2",
                 version="v2",
                 http=util.oauth_decorator.http())
@@ -51,10 +161,20 @@ class User (google.appengine.ext.ndb.Model):
 
         # Make sure the user information is actually useful (has an ID).
         if user_info and user_info.get("id"):
+            if cache_key is not None:
+                google.appengine.api.memcache.set(cache_key, user_info,
+                        time=USER_INFO_TTL)
             return user_info
         else:
             raise NoUserIdException(util.oauth_decorator.authorize_url())
 
+    @staticmethod
+    def forget_info():
+        """ Forget the current user's remembered profile information. """
+        cache_key = User.info_cache_key()
+        if cache_key is not None:
+            google.appengine.api.memcache.delete(cache_key)
+
 
 class LocationOfInterest (google.appengine.ext.ndb.Model):
     """ NDB model class for a location for which a user would like to receive
@@ -69,9 +189,12 @@ class LocationOfInterest (google.appengine.ext.ndb.Model):
     # * description: the human-readable description of location.
     # * location: the coordinates for which the current user would like to
     #   receive quake cards.
+    # * radius: how close an earthquake has to be to the location to be
+    #   interesting, in kilometres.
     owner = google.appengine.ext.ndb.StringProperty()
     description = google.appengine.ext.ndb.StringProperty()
     location = google.appengine.ext.ndb.GeoPtProperty()
+    radius = google.appengine.ext.ndb.FloatProperty(default=DEFAULT_RADIUS)
 
     @classmethod
     def query_user(cls, user_id):
@@ -81,3 +204,345 @@ class LocationOfInterest (google.appengine.ext.ndb.Model):
         user_id (string): the current user's ID.
         """
         return cls.query(cls.owner == user_id)
+
+    @classmethod
+    def snapshot(cls):
+        """ Get a LocationTable of every location of interest.
+        The table is kept between requests on this instance, and reloaded
+        only after some location of interest has been written.
+        """
+        global _snapshot
+        generation = cls.generation()
+        if _snapshot is None or _snapshot[0] != generation:
+            table = LocationTable()
+            for loi in cls.query().iter(batch_size=LOI_BATCH_SIZE):
+                table.add(loi.owner, loi.location.lon, loi.location.lat,
+                        loi.radius or DEFAULT_RADIUS)
+            _snapshot = (generation, table)
+        return _snapshot[1]
+
+    @staticmethod
+    def generation():
+        """ Get the number identifying the current set of locations. """
+        generation = google.appengine.api.memcache.get(LOI_GENERATION_KEY)
+        if generation is None:
+            # Memcache lost track, so start from a number no instance could
+            # have cached a snapshot for.
+            google.appengine.api.memcache.add(LOI_GENERATION_KEY,
+                    int(time.time() * 1000))
+            generation = google.appengine.api.memcache.get(LOI_GENERATION_KEY)
+        return generation
+
+    @staticmethod
+    def invalidate():
+        """ Mark every cached snapshot of the locations as stale. The put and
+        delete hooks call this for each location written on its own, and
+        put_all and delete_all once for a whole batch. Returns the new
+        generation.
+        """
+        return google.appengine.api.memcache.incr(LOI_GENERATION_KEY)
+
+    def _post_put_hook(self, future):
+        if not getattr(_batch_write, "active", False):
+            LocationOfInterest.invalidate()
+
+    @classmethod
+    def _post_delete_hook(cls, key, future):
+        if not getattr(_batch_write, "active", False):
+            cls.invalidate()
+
+    @classmethod
+    def put_all(cls, lois, batch_size=LOI_BATCH_SIZE, ):
+        """ Store locations of interest, a batch at a time. Returns their
+        keys. The cached snapshots are marked stale once, at the end, and if
+        this instance's snapshot was up to date, the new locations are added
+        to it instead of having it reloaded.
+
+        lois (iterable): the locations, which can be read as they're stored,
+            such as from a generator.
+        batch_size (int): most locations stored per datastore round trip.
+        """
+        global _snapshot
+        keys = []
+        rows = []
+        batch = []
+        def store(batch):
+            keys.extend(google.appengine.ext.ndb.put_multi(batch))
+            rows.extend((loi.owner, loi.location.lon, loi.location.lat,
+                    loi.radius or DEFAULT_RADIUS) for loi in batch)
+
+        _batch_write.active = True
+        try:
+            for loi in lois:
+                batch.append(loi)
+                if len(batch) >= batch_size:
+                    store(batch)
+                    batch = []
+            if batch:
+                store(batch)
+        finally:
+            # Even if only some were stored.
+            _batch_write.active = False
+            generation = cls.invalidate()
+        snapshot = _snapshot
+        if (snapshot is not None and generation is not None and
+                snapshot[0] == generation - 1):
+            # Nothing else was written in between.
+            table = snapshot[1].copy()
+            for row in rows:
+                table.add(*row)
+            _snapshot = (generation, table)
+        return keys
+
+    @classmethod
+    def delete_all(cls, keys):
+        """ Delete locations of interest by key in one batch. """
+        _batch_write.active = True
+        try:
+            google.appengine.ext.ndb.delete_multi(keys)
+        finally:
+            _batch_write.active = False
+        cls.invalidate()
+
+
+class FeedState (google.appengine.ext.ndb.Model):
+    """ NDB model class for what was seen the last time an earthquake feed
+    was fetched. Keyed by the feed's URI.
+    """
+
+    # Schema.
+    # * generated: the feed's metadata.generated timestamp (ms since epoch).
+    # * etag, last_modified: the feed's HTTP validators, for conditional
+    #   requests.
+    # * seen: when each earthquake event that has already been processed was
+    #   last updated (ms since the epoch), by event ID. Older states have a
+    #   list of IDs instead.
+    generated = google.appengine.ext.ndb.IntegerProperty(indexed=False)
+    etag = google.appengine.ext.ndb.StringProperty(indexed=False)
+    last_modified = google.appengine.ext.ndb.StringProperty(indexed=False)
+    seen = google.appengine.ext.ndb.JsonProperty(compressed=True, default={})
+
+    @classmethod
+    def for_feed(cls, uri):
+        """ Get the state of a feed, or a blank state if it's never been
+        fetched.
+        """
+        return cls.get_by_id(uri) or cls(id=uri)
+
+    def seen_updates(self):
+        """ Get when each seen event was last updated, by event ID. Events
+        from older states have None.
+        """
+        if isinstance(self.seen, list):
+            return dict.fromkeys(self.seen)
+        return dict(self.seen or {})
+
+
+class DeliveryLedger (google.appengine.ext.ndb.Model):
+    """ NDB model class for the earthquakes whose cards have already been
+    sent to a user, so that no earthquake is sent to the same user twice.
+    Keyed by the user's ID.
+
+    Deliveries claim the events they're about to send in a transaction (see
+    update()), and record them once they're sent, so deliveries running at
+    the same time neither send the same card nor lose each other's entries.
+    """
+
+    # Schema.
+    # * events: an entry for each delivered event, by USGS event ID, with
+    #   when the entry expires ("expires", seconds since the epoch), which
+    #   revision of the event was sent ("updated", ms since the epoch), the
+    #   timeline item it was sent as ("item") and its bundle ("bundle"), and
+    #   where the epicenter was ("lon", "lat"). Older ledgers only have the
+    #   expiry time instead of an entry.
+    # * expires: when the last entry expires, after which the whole ledger
+    #   can be deleted.
+    # * tokens, refilled: the user's allowance of cards, as the tokens left in
+    #   a scheduler.TokenBucket and when they were counted (seconds since the
+    #   epoch). Unset until the user is first sent a card.
+    # * claims: events that a delivery is sending the user, by USGS event ID,
+    #   with the delivery's token ("token") and when the claim runs out
+    #   ("until", seconds since the epoch).
+    # * delivered: the IDs of the events with a card that can be updated, for
+    #   finding who to send revisions to.
+    events = google.appengine.ext.ndb.JsonProperty(compressed=True,
+            default={})
+    delivered = google.appengine.ext.ndb.StringProperty(repeated=True)
+    expires = google.appengine.ext.ndb.DateTimeProperty()
+    tokens = google.appengine.ext.ndb.FloatProperty(indexed=False)
+    refilled = google.appengine.ext.ndb.FloatProperty(indexed=False)
+    claims = google.appengine.ext.ndb.JsonProperty(default={})
+
+    @classmethod
+    def update(cls, user_id, change):
+        """ Read, change and save a user's ledger in a transaction. Returns
+        the ledger.
+
+        user_id (str): the user's ID. Users without a ledger get a new one.
+        change (callable): takes the ledger and returns whether it changed
+            it. It's called again if the transaction has to be retried.
+        """
+        def transaction():
+            ledger = cls.get_by_id(user_id) or cls(id=user_id)
+            if change(ledger):
+                ledger.put()
+            return ledger
+        return google.appengine.ext.ndb.transaction(transaction)
+
+    @classmethod
+    def recipients(cls, event_ids):
+        """ Find the users who have been sent cards for events, and haven't
+        forgotten them yet. Returns lists of user IDs, by event ID.
+        """
+        event_ids = list(event_ids)
+        now = time.time()
+        recipients = {}
+        for start in range(0, len(event_ids), MAX_IN_VALUES):
+            wanted = event_ids[start:start + MAX_IN_VALUES]
+            for ledger in cls.query(cls.delivered.IN(wanted)):
+                for event_id in set(ledger.delivered) & set(wanted):
+                    # The list is only brought up to date when the ledger is
+                    # written, so the entry may have expired since.
+                    if ledger.entry(event_id, now) is not None:
+                        recipients.setdefault(event_id, []).append(
+                                ledger.key.id())
+        return recipients
+
+    @staticmethod
+    def _entry(value):
+        if isinstance(value, dict):
+            return value
+        return {"expires": value}
+
+    def entry(self, event_id, now=None, ):
+        """ Get the entry for an event that has been sent to the user, or
+        None if it hasn't been (or it's been forgotten).
+        """
+        value = (self.events or {}).get(event_id)
+        if value is None:
+            return None
+        entry = self._entry(value)
+        if entry["expires"] <= (now or time.time()):
+            return None
+        return entry
+
+    def record(self, entries, ttl, now=None, ):
+        """ Note that events have been sent to the user, and forget any that
+        have expired. Doesn't save the ledger.
+
+        entries (dict): entries for the events, by USGS event ID. Their
+            expiry times are filled in.
+        ttl (int): seconds to remember the events for.
+        """
+        now = now or time.time()
+        events = dict((event_id, value) for event_id, value
+                in (self.events or {}).items()
+                if self._entry(value)["expires"] > now)
+        for event_id, entry in entries.items():
+            events[event_id] = dict(entry, expires=now + ttl)
+        self.events = events
+        self.delivered = sorted(event_id for event_id, value in events.items()
+                if self._entry(value).get("item") is not None)
+        if events:
+            self.expires = datetime.datetime.utcfromtimestamp(max(
+                    self._entry(value)["expires"] for value in events.values()))
+
+    def claimant(self, event_id, now=None, ):
+        """ Get the token of the delivery that has claimed an event, or None
+        if no delivery has (or its claim has run out).
+        """
+        claim = (self.claims or {}).get(event_id)
+        if claim is None or claim["until"] <= (now or time.time()):
+            return None
+        return claim["token"]
+
+    def claim(self, event_ids, token, ttl, now=None, ):
+        """ Claim events for a delivery that's about to send them, and forget
+        claims that have run out. Doesn't save the ledger.
+
+        event_ids (list): USGS event IDs.
+        token (str): identifies the delivery.
+        ttl (int): seconds until the claims run out, if they aren't released
+            before then.
+        """
+        now = now or time.time()
+        claims = dict((event_id, claim) for event_id, claim
+                in (self.claims or {}).items() if claim["until"] > now)
+        for event_id in event_ids:
+            claims[event_id] = {"token": token, "until": now + ttl}
+        self.claims = claims
+        until = datetime.datetime.utcfromtimestamp(now + ttl)
+        if event_ids and (self.expires is None or self.expires < until):
+            self.expires = until
+
+    def release(self, event_ids, token):
+        """ Give up a delivery's claims on events. Doesn't save the ledger. """
+        claims = dict(self.claims or {})
+        for event_id in event_ids:
+            if claims.get(event_id, {}).get("token") == token:
+                del claims[event_id]
+        self.claims = claims
+
+    @classmethod
+    def expire(cls, batch_size=LOI_BATCH_SIZE):
+        """ Delete every ledger whose entries have all expired. Returns the
+        number deleted.
+        """
+        keys = cls.query(cls.expires < datetime.datetime.utcnow()).fetch(
+                keys_only=True)
+        for start in range(0, len(keys), batch_size):
+            google.appengine.ext.ndb.delete_multi(keys[start:start + batch_size])
+        return len(keys)
+
+
+class LocationTable (object):
+    """ Compact, array-backed table of locations of interest, for matching
+    against earthquakes. Row i is the location at (lons[i], lats[i]) with
+    radius radii[i] (km), owned by owners[owner_index[i]].
+    """
+
+    def __init__(self, ):
+        self.owners = []
+        self.owner_index = array.array("i")
+        self.lons = array.array("d")
+        self.lats = array.array("d")
+        self.radii = array.array("d")
+        self._owner_ids = {}
+
+    def add(self, owner, lon, lat, radius):
+        """ Append a location to the table. """
+        if owner not in self._owner_ids:
+            self._owner_ids[owner] = len(self.owners)
+            self.owners.append(owner)
+        self.owner_index.append(self._owner_ids[owner])
+        self.lons.append(lon)
+        self.lats.append(lat)
+        self.radii.append(radius)
+
+    def copy(self):
+        """ Make a copy of the table that can be added to without affecting
+        this one.
+        """
+        table = LocationTable()
+        table.owners = list(self.owners)
+        table.owner_index = array.array("i", self.owner_index)
+        table.lons = array.array("d", self.lons)
+        table.lats = array.array("d", self.lats)
+        table.radii = array.array("d", self.radii)
+        table._owner_ids = dict(self._owner_ids)
+        return table
+
+    def owner(self, row):
+        """ Get the ID of the user who owns a row. """
+        return self.owners[self.owner_index[row]]
+
+    def __len__(self):
+        return len(self.lons)
+
+
+# The most recent LocationOfInterest.snapshot(), with its generation.
+_snapshot = None
+
+# Set while LocationOfInterest.put_all or delete_all is writing in this
+# thread, so the hooks leave marking the snapshots stale to them.
+_batch_write = threading.local()
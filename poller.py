@@ -0,0 +1,108 @@
+""" Low-latency polling of the earthquake feed, as an alternative to fetching
+it from cron. Runs on the "poller" backend (see backends.yaml).
+"""
+import logging
+import time
+
+import google.appengine.api.background_thread
+import google.appengine.api.memcache
+import google.appengine.api.runtime
+import webapp2
+
+import fetch
+
+
+# Seconds between polls while the feed keeps changing, and the most to wait
+# while it doesn't.
+MIN_INTERVAL = 10
+MAX_INTERVAL = 60
+
+# How much longer to wait after each poll that finds no change.
+GROWTH = 1.5
+
+# Longest wait after polls keep failing.
+MAX_BACKOFF = 600
+
+# Seconds the poller's lease lasts past the time of its next poll, so that
+# it's held between polls.
+LEASE_SLACK = 30
+
+
+class AdaptivePoller (object):
+    """ Calls a polling function over and over, quickly while it keeps
+    finding changes, slowing down while it doesn't, and backing off
+    exponentially while it fails.
+    """
+
+    def __init__(self, poll, min_interval=MIN_INTERVAL,
+            max_interval=MAX_INTERVAL, max_backoff=MAX_BACKOFF, lease=None, ):
+        """ poll (callable): returns True if it found a change.
+        lease (callable): called with the seconds until the next poll, after
+            every poll.
+        """
+        self.poll = poll
+        self.lease = lease
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.max_backoff = max_backoff
+        self.interval = min_interval
+        self.failures = 0
+
+    def step(self):
+        """ Poll once. Returns the number of seconds to wait before the next
+        poll.
+        """
+        try:
+            changed = self.poll()
+        except Exception:
+            logging.exception("poll failed")
+            self.failures += 1
+            return min(self.max_backoff,
+                    self.min_interval * 2 ** self.failures)
+        self.failures = 0
+        if changed:
+            self.interval = self.min_interval
+        else:
+            self.interval = min(self.max_interval, self.interval * GROWTH)
+        return self.interval
+
+    def run(self, stopping, sleep=time.sleep, ):
+        """ Poll until told to stop.
+
+        stopping (callable): returns True when it's time to stop.
+        sleep (callable): waits a number of seconds.
+        """
+        while not stopping():
+            delay = self.step()
+            if self.lease is not None:
+                self.lease(delay)
+            # Wake up every second to check whether to stop.
+            deadline = time.time() + delay
+            while not stopping() and time.time() < deadline:
+                sleep(min(1.0, deadline - time.time()))
+
+
+def poll_feed():
+    """ Fetch and process the earthquake feed once. Returns True if it had
+    changed.
+    """
+    return fetch.QuakeDataFetchHandler().poll()
+
+
+def hold_lease(delay):
+    """ Tell the /fetch cron job that the poller is running, until a little
+    after its next poll is due.
+    """
+    google.appengine.api.memcache.set(fetch.POLLER_LEASE_KEY, True,
+            time=int(delay) + LEASE_SLACK)
+
+
+class PollerStartHandler (webapp2.RequestHandler):
+    """ Request handler for the backend starting up. Starts polling in the
+    background, until the backend shuts down.
+    """
+
+    def get(self):
+        poller = AdaptivePoller(poll_feed, lease=hold_lease)
+        google.appengine.api.background_thread.start_new_background_thread(
+                poller.run, [google.appengine.api.runtime.is_shutting_down])
@@ -0,0 +1,291 @@
+""" Replay a historical USGS catalog through the notification pipeline, to
+see which cards it would have sent to the current users.
+
+Streams a catalog file from disk, either GeoJSON like the feed or CSV from
+the USGS catalog search, and splits it into windows of time as it's read. A
+pool of processes runs each window through the same stages as
+QuakeDataFetchHandler: keeping the latest revision of each earthquake,
+matching against the locations of interest, and building each user's cards,
+which are delivered to a fakes.FakeMirror instead of the Mirror API.
+Delivery limits and the delivery ledger aren't applied.
+
+Locations of interest come from files exported from /loi/bulk, one per user,
+named after the user's ID (such as 1234.csv or 1234.geojson). Like
+benchmark.py, run it from the application directory with client_secrets.json
+in place:
+
+    python replay.py --sdk ~/google_appengine --catalog 2014-01.csv \\
+            --lois exports/ --output replay/ --processes 4 --radius 100
+
+Writes notifications.json, the event IDs each user would have been sent,
+and stats.json, the throughput and the time spent in each stage.
+"""
+import argparse
+import csv
+import glob
+import io
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+import benchmark
+
+
+# Default length of the windows the catalog is split into.
+WINDOW = 24 # hours
+
+# Extensions of exported locations of interest, and of GeoJSON catalogs.
+EXPORT_PATTERNS = ["*.csv", "*.geojson", "*.json"]
+GEOJSON_EXTENSIONS = (".geojson", ".json")
+
+
+def export_paths(paths):
+    """ Get the export files in a list of files and directories. """
+    for path in paths:
+        if os.path.isdir(path):
+            for pattern in EXPORT_PATTERNS:
+                for found in sorted(glob.glob(os.path.join(path, pattern))):
+                    yield found
+        else:
+            yield path
+
+
+def load_lois(paths, radius=None, ):
+    """ Read locations of interest from files exported from /loi/bulk.
+    Returns a list of (owner, lon, lat, radius) and the number of rows
+    without usable coordinates.
+
+    paths (list): export files, or directories of them, named by user ID.
+    radius (float): radius to use for every location instead of its own, in
+        km.
+    """
+    import bulk
+    import models
+
+    lois = []
+    skipped = 0
+    for path in export_paths(paths):
+        owner = os.path.splitext(os.path.basename(path))[0]
+        with io.open(path, "rb") as f:
+            if path.endswith(GEOJSON_EXTENSIONS):
+                rows = bulk.geojson_rows(f)
+            else:
+                rows = bulk.csv_rows(f)
+            for row in bulk.geocoded(rows):
+                try:
+                    lat, lng = float(row[1]), float(row[2])
+                except (TypeError, ValueError):
+                    skipped += 1
+                    continue
+                lois.append((owner, lng, lat, radius or
+                        float(row[3] or models.DEFAULT_RADIUS)))
+    return lois, skipped
+
+
+def read_catalog(path):
+    """ Stream earthquakes from a catalog file, as feed.Quake records. """
+    import feed
+
+    with io.open(path, "rb") as f:
+        if path.endswith(GEOJSON_EXTENSIONS):
+            for quake in feed.FeedReader(f, feed.Quake.from_feature):
+                yield quake
+        else:
+            for row in csv.DictReader(f):
+                yield feed.Quake.from_catalog_row(row)
+
+
+def split_windows(quakes, length):
+    """ Group earthquakes into windows of time as they're read. Yields the
+    start of each window (ms since the epoch) and the fields of its
+    earthquakes, from feed.Quake.fields(), as soon as the earthquakes move
+    past it. Catalogs are sorted by time, one way or the other, so only one
+    window is held at a time; an unsorted one has windows yielded in parts.
+
+    quakes (iterable): feed.Quake records, such as from read_catalog().
+    length (int): ms in each window.
+    """
+    start, fields = None, []
+    for quake in quakes:
+        window = quake.time // length * length
+        if window != start:
+            if fields:
+                yield start, fields
+            start, fields = window, []
+        fields.append(quake.fields())
+    if fields:
+        yield start, fields
+
+
+# What each worker process replays with, set up by start_worker.
+_worker = {}
+
+
+def start_worker(sdk, lois, latency):
+    """ Set up a worker process: the SDK, the table of locations of
+    interest, and fake map downloads.
+    """
+    benchmark.setup_paths(sdk)
+    import fakes
+    import mapcache
+    import models
+
+    table = models.LocationTable()
+    for owner, lon, lat, radius in lois:
+        table.add(owner, lon, lat, radius)
+    _worker["table"] = table
+    _worker["latency"] = latency
+    mapcache.maps = mapcache.MapImageCache(use_memcache=False,
+            download=fakes.FakeStaticMaps(latency))
+
+
+def replay_window(window):
+    """ Replay one window of the catalog in a worker process.
+
+    window (tuple): the start of the window (ms since the epoch) and the
+        fields of its earthquakes, from feed.Quake.fields().
+
+    Returns a dict of what was sent to each user, and counts and timings.
+    """
+    import fakes
+    import feed
+    import fetch
+    import stats
+
+    start, fields = window
+    run = stats.PipelineStats("replay")
+    started = time.time()
+
+    # A catalog can have several revisions of an earthquake. Only the latest
+    # counts, as if it were the one the feed had.
+    with run.stage("filter"):
+        latest = {}
+        for quake in (feed.Quake.from_fields(f) for f in fields):
+            if (quake.id not in latest or
+                    quake.updated > latest[quake.id].updated):
+                latest[quake.id] = quake
+        quakes = sorted(latest.values(), key=lambda quake: quake.time)
+    run.count("filter", "items", len(quakes))
+
+    with run.stage("match"):
+        quakes_by_owner, _, matches = fetch.match_quakes(quakes,
+                _worker["table"])
+    run.count("match", "matches", matches)
+    run.count("match", "users", len(quakes_by_owner))
+
+    # Build and "send" each user's cards the way a delivery shard does.
+    sink = fakes.FakeMirror(_worker["latency"])
+    handler = fetch.DeliveryShardHandler()
+    handler.stats = run
+    handler.cards = {}
+    notifications = {}
+    for owner, owner_quakes in sorted(quakes_by_owner.items()):
+        responses = handler.insert_quakes(sink, owner_quakes)
+        notifications[owner] = sorted(event_id for event_id, response
+                in responses.items() if response is not None)
+
+    return {
+            "start": start,
+            "quakes": len(quakes),
+            "matches": matches,
+            "notifications": notifications,
+            "cards": len(sink.items),
+            "round_trips": sink.round_trips,
+            "seconds": time.time() - started,
+            "stages": run.as_dict()["stages"],
+    }
+
+
+def merge_stages(total, stages):
+    """ Add one window's stage timings and counts to the totals. """
+    for name, stage in stages.items():
+        merged = total.setdefault(name, {"seconds": 0.0, "counts": {}})
+        merged["seconds"] += stage["seconds"]
+        for counter, n in stage["counts"].items():
+            merged["counts"][counter] = merged["counts"].get(counter, 0) + n
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+            description="Replay a USGS catalog through the notifier.")
+    parser.add_argument("--sdk", default=os.environ.get("APPENGINE_SDK",
+            os.path.expanduser("~/google_appengine")),
+            help="path to the App Engine Python SDK")
+    parser.add_argument("--catalog", required=True,
+            help="catalog file, CSV or GeoJSON")
+    parser.add_argument("--lois", required=True, action="append",
+            help="export of a user's locations of interest, named by the "
+            "user's ID, or a directory of them")
+    parser.add_argument("--output", default="replay",
+            help="directory to write the results to")
+    parser.add_argument("--processes", type=int,
+            default=multiprocessing.cpu_count())
+    parser.add_argument("--window", type=float, default=WINDOW,
+            help="hours of the catalog replayed at a time")
+    parser.add_argument("--radius", type=float,
+            help="km around every location of interest, instead of its own")
+    parser.add_argument("--latency", type=float, default=0.0,
+            help="seconds of simulated latency per Mirror/Maps round trip")
+    args = parser.parse_args(argv)
+    benchmark.setup_paths(args.sdk)
+
+    lois, skipped = load_lois(args.lois, args.radius)
+    print "%d locations of interest (%d skipped)" % (len(lois), skipped)
+
+    # Split the catalog into windows as it's read, and hand each one to the
+    # pool as soon as it's complete, instead of reading the whole catalog
+    # first.
+    started = time.time()
+    counts = {"read": 0, "windows": 0}
+    def windows():
+        for start, fields in split_windows(read_catalog(args.catalog),
+                int(args.window * 3600 * 1000)):
+            counts["read"] += len(fields)
+            counts["windows"] += 1
+            yield start, fields
+
+    pool = multiprocessing.Pool(args.processes, start_worker,
+            (args.sdk, lois, args.latency))
+    notifications = {}
+    stages = {}
+    totals = {"quakes": 0, "matches": 0, "cards": 0, "round_trips": 0}
+    try:
+        for result in pool.imap_unordered(replay_window, windows()):
+            for owner, event_ids in result["notifications"].items():
+                notifications.setdefault(owner, set()).update(event_ids)
+            for name in totals:
+                totals[name] += result[name]
+            merge_stages(stages, result["stages"])
+    finally:
+        pool.close()
+        pool.join()
+    seconds = time.time() - started
+    read = counts["read"]
+
+    report = dict(totals,
+            read=read,
+            windows=counts["windows"],
+            processes=args.processes,
+            users=len(notifications),
+            locations=len(lois),
+            seconds=seconds,
+            quakes_per_s=read / seconds if seconds else 0.0,
+            cards_per_s=totals["cards"] / seconds if seconds else 0.0,
+            stages=stages)
+    if not os.path.isdir(args.output):
+        os.makedirs(args.output)
+    with open(os.path.join(args.output, "notifications.json"), "w") as f:
+        json.dump(dict((owner, sorted(event_ids)) for owner, event_ids
+                in notifications.items()), f, indent=1, sort_keys=True)
+    with open(os.path.join(args.output, "stats.json"), "w") as f:
+        json.dump(report, f, indent=1, sort_keys=True)
+    print ("%d earthquakes in %d windows, %d cards to %d users in %.1f s "
+            "(%.1f earthquakes/s)") % (read, counts["windows"],
+            totals["cards"], len(notifications), seconds,
+            report["quakes_per_s"])
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,138 @@
+""" Deciding which cards to send first, and which not to send individually at
+all, when there's more to deliver than the Mirror API quota allows.
+"""
+import collections
+import heapq
+import itertools
+import math
+import threading
+import time
+
+
+class TokenBucket (object):
+    """ Rate limit that allows bursts. Holds up to `capacity` tokens, which
+    refill at `rate` tokens a second; each card sent takes one. Safe to use
+    from several threads at once.
+    """
+
+    def __init__(self, rate, capacity, tokens=None, updated=None,
+            clock=time.time, ):
+        """ rate (float): tokens added each second.
+        capacity (float): most tokens the bucket holds.
+        tokens (float): tokens in the bucket at `updated`, for restoring a
+            saved bucket. A new bucket starts full.
+        updated (float): when `tokens` was measured, in seconds since the
+            epoch.
+        clock (callable): gets the current time.
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self.clock = clock
+        self.tokens = capacity if tokens is None else tokens
+        self.updated = clock() if updated is None else updated
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = self.clock()
+        if now > self.updated:
+            self.tokens = min(self.capacity,
+                    self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def available(self, n=1, ):
+        """ Whether `n` tokens could be taken now. """
+        with self._lock:
+            self._refill()
+            return self.tokens >= n
+
+    def take(self, n=1, ):
+        """ Take `n` tokens if there are enough. Returns whether they were
+        taken.
+        """
+        with self._lock:
+            self._refill()
+            if self.tokens < n:
+                return False
+            self.tokens -= n
+            return True
+
+    def spend(self, n=1, ):
+        """ Take away `n` tokens that were used through another copy of the
+        bucket, leaving none if there aren't that many.
+        """
+        with self._lock:
+            self._refill()
+            self.tokens = max(0.0, self.tokens - n)
+
+
+def priority(quake, distance):
+    """ How important it is to tell a user about an earthquake. Bigger
+    earthquakes come first, then ones nearer the user, since shaking falls
+    off roughly with the logarithm of distance.
+
+    quake (feed.Quake): the earthquake.
+    distance (float): km from the user's nearest location of interest to the
+        epicenter, or None if it isn't known.
+    """
+    return (quake.mag or 0.0) - math.log10(1.0 + (distance or 0.0) / 10.0)
+
+
+class DeliveryScheduler (object):
+    """ Priority queue of (user, earthquake) cards to send, drained within a
+    per-user and a global rate limit.
+
+    Cards that don't fit either limit are coalesced into the user's bundle
+    cover instead of being sent on their own. The cover still takes a token
+    from the global limit; if there isn't one, the cards are deferred.
+    """
+
+    def __init__(self, quota, user_buckets, ):
+        """ quota (TokenBucket): the limit on cards sent to every user.
+        user_buckets (dict): each user's own TokenBucket, by user ID.
+        """
+        self.quota = quota
+        self.user_buckets = user_buckets
+        self._heap = []
+        self._order = itertools.count()
+
+    def __len__(self):
+        return len(self._heap)
+
+    def add(self, user_id, quake, distance=None, coalesce=True, ):
+        """ Queue a card.
+
+        coalesce (bool): whether the card can go into a bundle cover if it
+            doesn't fit the limits. If it can't, it's deferred instead.
+        """
+        # Ties go to the card queued first.
+        heapq.heappush(self._heap, (-priority(quake, distance),
+                next(self._order), user_id, quake, coalesce))
+
+    def drain(self):
+        """ Decide what to do with every queued card, most important first.
+
+        Returns three dicts of lists of feed.Quake records, by user ID: the
+        earthquakes to send cards for, the ones to coalesce into the bundle
+        cover, and the ones to try again later. Each list is in priority
+        order, and so is the first dict.
+        """
+        send = collections.OrderedDict()
+        coalesced = {}
+        deferred = {}
+        while self._heap:
+            _, _, user_id, quake, coalesce = heapq.heappop(self._heap)
+            bucket = self.user_buckets[user_id]
+            # Only take from the user's bucket if the global one allows it
+            # too, so a refused card doesn't use up the user's allowance.
+            if bucket.available() and self.quota.take():
+                bucket.take()
+                send.setdefault(user_id, []).append(quake)
+            elif coalesce:
+                coalesced.setdefault(user_id, []).append(quake)
+            else:
+                deferred.setdefault(user_id, []).append(quake)
+
+        for user_id in list(coalesced):
+            if not self.quota.take():
+                deferred.setdefault(user_id, []).extend(coalesced.pop(user_id))
+        return send, coalesced, deferred
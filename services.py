@@ -0,0 +1,70 @@
+""" Factory for Google API service objects that doesn't download the API's
+discovery document every time a service object is built.
+"""
+import os
+import threading
+import time
+import urllib2
+
+import apiclient.discovery
+import google.appengine.api.memcache
+
+
+# Where discovery documents come from when they aren't bundled or cached.
+DISCOVERY_URI = "https://www.googleapis.com/discovery/v1/apis/%s/%s/rest"
+
+# Directory of bundled discovery documents, named like "mirror.v1.json".
+# Documents found here are used as they are and never expire.
+BUNDLED_DIR = os.path.join(os.path.dirname(__file__), "discovery")
+
+# How long a downloaded discovery document is used before downloading it
+# again, and the memcache prefix for sharing them between instances.
+TTL = 24 * 3600 # seconds
+MEMCACHE_PREFIX = "discovery:"
+
+# Discovery documents held on this instance, by (service name, version), as
+# (time loaded, document text).
+_documents = {}
+_lock = threading.Lock()
+
+
+def document(serviceName, version):
+    """ Get the discovery document for an API, from the first of: this
+    instance, the bundled copies, memcache, or the discovery service.
+    """
+    key = (serviceName, version)
+    with _lock:
+        entry = _documents.get(key)
+    if entry is not None and (entry[0] is None or time.time() - entry[0] < TTL):
+        return entry[1]
+
+    path = os.path.join(BUNDLED_DIR, "%s.%s.json" % key)
+    if os.path.exists(path):
+        with open(path) as f:
+            entry = (None, f.read())
+    else:
+        cache_key = MEMCACHE_PREFIX + "%s.%s" % key
+        text = google.appengine.api.memcache.get(cache_key)
+        if text is None:
+            text = urllib2.urlopen(DISCOVERY_URI % key).read()
+            google.appengine.api.memcache.set(cache_key, text, time=TTL)
+        entry = (time.time(), text)
+
+    with _lock:
+        _documents[key] = entry
+    return entry[1]
+
+
+def build(serviceName, version, http):
+    """ Build a service object for an API, the same as
+    apiclient.discovery.build but without a network round trip in the common
+    case.
+
+    serviceName (str): name of the API, such as "mirror".
+    version (str): version of the API, such as "v1".
+    http (httplib2.Http): the (usually authorized) connection to use.
+    """
+    # The document is kept as text because building a service fills in parts
+    # of the description it's given, so a parsed copy can't be shared.
+    return apiclient.discovery.build_from_document(
+            document(serviceName, version), http=http)
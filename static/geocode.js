@@ -59,6 +59,10 @@ function geocodeLoi() {
 }
 function onLoiChanged() {
     window.loiChanged = true;
+    // Until the new name is geocoded, leave the coordinates empty, so the
+    // server looks the name up itself if the geocoder fails.
+    document.getElementById("lng").value = "";
+    document.getElementById("lat").value = "";
 }
 function init() {
     window.loiChanged = false;
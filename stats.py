@@ -0,0 +1,140 @@
+""" Timing and counters for the stages of the notification pipeline.
+"""
+import contextlib
+import json
+import logging
+import threading
+import time
+
+import google.appengine.api.memcache
+
+
+# Memcache prefix for the most recent runs of each pipeline, and how many
+# runs are kept.
+MEMCACHE_PREFIX = "stats:"
+RECENT_RUNS = 20
+
+
+class PipelineStats (object):
+    """ Wall time, item counts and error counts for each stage of one run of
+    a pipeline. Safe to use from several threads at once.
+    """
+
+    def __init__(self, pipeline, ):
+        """ pipeline (str): name of the pipeline, such as "fetch". """
+        self.pipeline = pipeline
+        self.started = time.time()
+        self.stages = {}
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _get(self, name):
+        stage = self.stages.get(name)
+        if stage is None:
+            stage = self.stages[name] = {"seconds": 0.0, "calls": 0,
+                    "errors": 0, "counts": {}}
+        return stage
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """ Time a block of code as part of a stage. An exception from the
+        block counts as an error in the stage, and is re-raised.
+        """
+        start = time.time()
+        try:
+            yield
+        except:
+            self.error(name)
+            raise
+        finally:
+            self.add_time(name, time.time() - start)
+
+    def add_time(self, name, seconds):
+        """ Add time measured some other way to a stage. """
+        with self._lock:
+            stage = self._get(name)
+            stage["seconds"] += max(seconds, 0.0)
+            stage["calls"] += 1
+
+    def seconds(self, name):
+        """ Get the total time spent in a stage so far. """
+        with self._lock:
+            return self.stages.get(name, {}).get("seconds", 0.0)
+
+    def timed(self, name, iterable):
+        """ Iterate over something, timing how long it takes to produce each
+        item as part of a stage, and counting the items.
+        """
+        iterator = iter(iterable)
+        while True:
+            with self.stage(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            self.count(name, "items")
+            yield item
+
+    def count(self, name, counter, n=1, ):
+        """ Add to one of a stage's counters. """
+        with self._lock:
+            counts = self._get(name)["counts"]
+            counts[counter] = counts.get(counter, 0) + n
+
+    def error(self, name, n=1, ):
+        """ Count errors in a stage. """
+        with self._lock:
+            self._get(name)["errors"] += n
+
+    def observe(self, name, value):
+        """ Record one measurement, such as a latency, for a stage. The run
+        reports the distribution of the measurements.
+        """
+        with self._lock:
+            self._get(name)
+            self._values.setdefault(name, []).append(value)
+
+    def cache(self, name, hits, misses):
+        """ Record a stage's cache hits and misses. """
+        self.count(name, "cache_hits", hits)
+        self.count(name, "cache_misses", misses)
+
+    def as_dict(self):
+        with self._lock:
+            stages = json.loads(json.dumps(self.stages))
+            values = dict((name, sorted(v)) for name, v in self._values.items())
+        for name, v in values.items():
+            stages[name]["distribution"] = {
+                    "count": len(v),
+                    "p50": v[len(v) // 2],
+                    "p90": v[min(len(v) - 1, len(v) * 9 // 10)],
+                    "max": v[-1],
+            }
+        for stage in stages.values():
+            counts = stage["counts"]
+            lookups = counts.get("cache_hits", 0) + counts.get("cache_misses", 0)
+            if lookups:
+                stage["cache_hit_rate"] = counts.get("cache_hits", 0) / float(lookups)
+        return {
+                "pipeline": self.pipeline,
+                "started": self.started,
+                "seconds": time.time() - self.started,
+                "stages": stages,
+        }
+
+    def finish(self):
+        """ Log the run as structured JSON and remember it for the admin
+        stats page. Returns the run as a dict.
+        """
+        run = self.as_dict()
+        logging.info("pipeline stats: %s", json.dumps(run, sort_keys=True))
+        key = MEMCACHE_PREFIX + self.pipeline
+        runs = google.appengine.api.memcache.get(key) or []
+        runs = ([run] + runs)[:RECENT_RUNS]
+        google.appengine.api.memcache.set(key, runs)
+        return run
+
+
+def recent(pipeline):
+    """ Get the most recent runs of a pipeline, newest first. """
+    return google.appengine.api.memcache.get(MEMCACHE_PREFIX + pipeline) or []
@@ -0,0 +1,17 @@
+""" Tests, run from the application directory with:
+
+    python -m unittest discover -s tests -t .
+"""
+import os
+import sys
+
+import benchmark
+
+
+# The App Engine SDK, for the modules that use its APIs, and the libraries
+# in lib/, as main.py has them.
+SDK = os.environ.get("APPENGINE_SDK", os.path.expanduser("~/google_appengine"))
+if os.path.isdir(SDK):
+    benchmark.setup_paths(SDK)
+else:
+    sys.path.insert(0, "lib")
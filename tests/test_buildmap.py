@@ -0,0 +1,39 @@
+""" Tests for splitting map lines into tiles.
+"""
+import unittest
+
+import buildmap
+
+
+COLUMNS = 180
+ROWS = 90
+
+
+class SplitTest (unittest.TestCase):
+
+    def tiles(self, points):
+        return sorted(tile for tile, _ in buildmap.split(points, 2.0, COLUMNS,
+                ROWS))
+
+    def test_segment_within_one_tile(self):
+        self.assertEqual(self.tiles([(0.5, 0.5), (1.5, 1.5)]), [(90, 45)])
+
+    def test_antimeridian_east_to_west(self):
+        # Only the columns at either edge of the map, not every column.
+        tiles = self.tiles([(179.0, 10.0), (-179.0, 20.0)])
+        self.assertEqual(set(column for column, _ in tiles),
+                set([0, COLUMNS - 1]))
+
+    def test_antimeridian_west_to_east(self):
+        tiles = self.tiles([(-179.0, 10.0), (179.0, 20.0)])
+        self.assertEqual(set(column for column, _ in tiles),
+                set([0, COLUMNS - 1]))
+
+    def test_antimeridian_crossing_point(self):
+        pieces = list(buildmap.segments([(179.0, 10.0), (-179.0, 20.0)]))
+        self.assertEqual(pieces, [((179.0, 10.0), (180.0, 15.0)),
+                ((-180.0, 15.0), (-179.0, 20.0))])
+
+
+if __name__ == "__main__":
+    unittest.main()
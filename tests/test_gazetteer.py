@@ -0,0 +1,69 @@
+""" Tests for geocoding place names, against a small gazetteer built for
+them.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+import buildgazetteer
+import gazetteer
+
+
+# (display name, lat, lng, population, names to index)
+PLACES = [
+        (u"Springfield, Missouri, US", 37.21533, -93.29824, 166810,
+                [u"Springfield"]),
+        (u"Springfield, Illinois, US", 39.80172, -89.64371, 116250,
+                [u"Springfield"]),
+        (u"Tokyo, Tokyo, JP", 35.6895, 139.69171, 8336599,
+                [u"Tokyo", u"Edo"]),
+        (u"Christchurch, Canterbury, NZ", -43.53333, 172.63333, 363926,
+                [u"Christchurch"]),
+        (u"Homestead, Florida, US", 25.46872, -80.47756, 67481,
+                [u"Homestead"]),
+]
+
+
+class GeocodeAllTest (unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+        path = os.path.join(cls.directory, "places.bin")
+        buildgazetteer.build(PLACES, path)
+        cls.places = gazetteer.Gazetteer(path)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.directory)
+
+    def geocode(self, *names):
+        return gazetteer.geocode_all(list(names), self.places)
+
+    def test_exact_names(self):
+        tokyo, edo = self.geocode("Tokyo", "Edo")
+        self.assertEqual(tokyo["name"], u"Tokyo, Tokyo, JP")
+        self.assertEqual(edo["name"], u"Tokyo, Tokyo, JP")
+
+    def test_qualifier(self):
+        place, = self.geocode("Springfield, Illinois")
+        self.assertEqual(place["name"], u"Springfield, Illinois, US")
+
+    def test_misspelling(self):
+        place, = self.geocode("Christchrch")
+        self.assertEqual(place["name"], u"Christchurch, Canterbury, NZ")
+
+    def test_non_places(self):
+        self.assertEqual(self.geocode("field office", "Home", "", "asdf"),
+                [None, None, None, None])
+
+    def test_same_order_as_names(self):
+        names = ["Edo", "field office", "Edo"]
+        places = self.geocode(*names)
+        self.assertIsNone(places[1])
+        self.assertEqual(places[0], places[2])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,57 @@
+""" Tests for the map image cache.
+"""
+import threading
+import time
+import unittest
+
+import mapcache
+
+
+class SlowDownload (object):
+    """ Downloads an image slowly, counting the downloads. """
+
+    def __init__(self, fail=False, ):
+        self.fail = fail
+        self.downloads = 0
+
+    def __call__(self, url):
+        self.downloads += 1
+        time.sleep(0.05)
+        if self.fail:
+            raise IOError("no map")
+        return "image of " + url
+
+
+class MapImageCacheTest (unittest.TestCase):
+
+    def get_at_once(self, cache, url, threads=10):
+        results = []
+        def get():
+            results.append(cache.get(url))
+        workers = [threading.Thread(target=get) for _ in range(threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        return results
+
+    def test_downloaded_once_for_every_thread(self):
+        download = SlowDownload()
+        cache = mapcache.MapImageCache(use_memcache=False, download=download)
+        results = self.get_at_once(cache, "http://maps/a")
+        self.assertEqual(download.downloads, 1)
+        self.assertEqual(results, ["image of http://maps/a"] * 10)
+        self.assertEqual((cache.misses, cache.hits), (1, 9))
+
+    def test_failure_is_shared_but_not_cached(self):
+        download = SlowDownload(fail=True)
+        cache = mapcache.MapImageCache(use_memcache=False, download=download)
+        self.assertEqual(self.get_at_once(cache, "http://maps/a"), [""] * 10)
+        self.assertEqual(download.downloads, 1)
+        self.assertEqual(cache.errors, 1)
+        cache.get("http://maps/a")
+        self.assertEqual(download.downloads, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
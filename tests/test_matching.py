@@ -0,0 +1,43 @@
+""" Tests for matching earthquakes against locations of interest.
+"""
+import unittest
+
+import numpy
+
+import matching
+
+
+class MatchTest (unittest.TestCase):
+
+    def setUp(self):
+        rng = numpy.random.RandomState(1)
+        self.quakes = (rng.uniform(-180, 180, 300), rng.uniform(-80, 80, 300))
+        self.lois = (rng.uniform(-180, 180, 2000),
+                rng.uniform(-80, 80, 2000), rng.uniform(10, 500, 2000))
+
+    def pairs(self, **kwargs):
+        quakes, lois = matching.match(*(self.quakes + self.lois), **kwargs)
+        return sorted(zip(quakes.tolist(), lois.tolist()))
+
+    def test_same_as_comparing_every_pair(self):
+        lons, lats, radii = self.lois
+        within = matching.haversine(self.quakes[0][:, numpy.newaxis],
+                self.quakes[1][:, numpy.newaxis], lons, lats) <= radii
+        expected = sorted(zip(*[indices.tolist()
+                for indices in numpy.nonzero(within)]))
+        self.assertTrue(expected)
+        self.assertEqual(self.pairs(), expected)
+
+    def test_blocks_of_locations(self):
+        # Bounding the pairs compared at once doesn't change the matches.
+        self.assertEqual(self.pairs(max_pairs=1000), self.pairs())
+        self.assertEqual(self.pairs(max_pairs=1), self.pairs())
+
+    def test_nothing_to_match(self):
+        quakes, lois = matching.match([], [], *self.lois)
+        self.assertEqual(len(quakes), 0)
+        self.assertEqual(len(lois), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
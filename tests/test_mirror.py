@@ -0,0 +1,94 @@
+""" Tests for sending timeline cards in batches, against fakes.FakeMirror.
+"""
+import unittest
+
+import fakes
+import mirror
+
+
+# A PNG to attach, as a map would be.
+IMAGE = fakes.FakeStaticMaps.IMAGE
+
+
+class FlakyRequest (object):
+    """ Makes requests that fail the first `failures` times they're run. """
+
+    def __init__(self, timeline, failures, ):
+        self.timeline = timeline
+        self.failures = failures
+
+    def __call__(self):
+        request = self.timeline.insert(body={"text": "flaky"})
+        run = request.run
+        def flaky():
+            if self.failures:
+                self.failures -= 1
+                raise IOError("try again")
+            return run()
+        request.run = flaky
+        return request
+
+
+class ExecuteBatchTest (unittest.TestCase):
+
+    def setUp(self):
+        self.service = fakes.FakeMirror()
+        self.timeline = self.service.timeline()
+
+    def inserts(self, count, image=None):
+        return [mirror.insert_request(self.timeline, {"text": str(i)}, image)
+                for i in range(count)]
+
+    def test_cards_share_one_round_trip(self):
+        responses = mirror.execute_batch(self.service, self.inserts(5))
+        self.assertEqual(self.service.round_trips, 1)
+        self.assertEqual([response["text"] for response in responses],
+                ["0", "1", "2", "3", "4"])
+
+    def test_large_requests_are_split_into_batches(self):
+        count = mirror.BATCH_SIZE + 1
+        responses = mirror.execute_batch(self.service, self.inserts(count))
+        self.assertEqual(self.service.round_trips, 2)
+        self.assertEqual(len(self.service.items), count)
+        self.assertNotIn(None, responses)
+
+    def test_uploads_are_sent_on_their_own(self):
+        requests = self.inserts(2) + self.inserts(2, IMAGE)
+        responses = mirror.execute_batch(self.service, requests)
+        # One batch for the cards without maps, and one request per map.
+        self.assertEqual(self.service.round_trips, 3)
+        self.assertEqual(self.service.uploads, 2)
+        self.assertNotIn(None, responses)
+
+    def test_batches_refuse_uploads(self):
+        batch = self.service.new_batch_http_request()
+        request = self.timeline.insert(body={}, media_body=IMAGE)
+        self.assertRaises(ValueError, batch.add, request)
+
+    def test_only_failed_requests_are_retried(self):
+        requests = self.inserts(3) + [FlakyRequest(self.timeline, 1)]
+        responses = mirror.execute_batch(self.service, requests)
+        self.assertEqual(self.service.round_trips, 2)
+        self.assertEqual(len(self.service.items), 4)
+        self.assertNotIn(None, responses)
+
+    def test_requests_fail_after_the_retries(self):
+        requests = self.inserts(1) + [FlakyRequest(self.timeline,
+                mirror.RETRIES + 1)]
+        responses = mirror.execute_batch(self.service, requests)
+        self.assertEqual(self.service.round_trips, mirror.RETRIES + 1)
+        self.assertIsNotNone(responses[0])
+        self.assertIsNone(responses[1])
+
+    def test_lost_batch_is_not_sent_again(self):
+        self.service.lost_batches = 1
+        requests = self.inserts(3) + [FlakyRequest(self.timeline, 1)]
+        responses = mirror.execute_batch(self.service, requests)
+        # The cards that went through before the batch failed aren't
+        # inserted twice.
+        self.assertEqual(len(self.service.items), 4)
+        self.assertNotIn(None, responses)
+
+
+if __name__ == "__main__":
+    unittest.main()
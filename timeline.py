@@ -4,23 +4,24 @@
             cards, but will also be useful for handling actual quake data.
 * io:       BytesIO, for packaging map images for attachment to the
             Mirror API request.
-* urllib2:  fetching map images from the Google Static Maps API.
 """
 import datetime
 import io
-import urllib2
 
 # Import modules for working with Google APIs.
 """
-* apiclient.discovery: building the Mirror service object.
 * apiclient.http:      packaging attachments for API requests.
 """
-import apiclient.discovery
 import apiclient.http
 
 # Import the template support function, authorization decorator, and base
-# request handler.
+# request handler, the map renderer and the cache for map images from the
+# Google Static Maps API, and the factory for building the Mirror service
+# object.
 import util
+import mapcache
+import maprender
+import services
 
 
 def quakemap(lng, lat):
@@ -54,7 +55,7 @@ class TimelineHandler (util.TemplatingBaseHandler):
             self.error(403)
 
         # Request a service object for the Mirror API.
-        mirror = apiclient.discovery.build(
+        mirror = services.build(
                 serviceName="mirror",
                 version="v1",
                 http=util.oauth_decorator.http())
@@ -63,20 +64,25 @@ class TimelineHandler (util.TemplatingBaseHandler):
         card = self.quake_card()
         mapimg = self.map_image()
 
-        # Create a helper for attaching the map image to the API request.
+        # Publish the quake card to the user's Glass timeline, with the map
+        # image attached if there is one.
+        timeline_transaction = mirror.timeline()
+        if not mapimg:
+            timeline_transaction.insert(body=card).execute()
+            return
         media_body = apiclient.http.MediaIoBaseUpload(io.BytesIO(mapimg),
                 mimetype="image/png", resumable=True)
-
-        # Publish the quake card to the user's Glass timeline.
-        timeline_transaction = mirror.timeline()
         timeline_transaction.insert(body=card, media_body=media_body).execute()
 
     def map_image(self):
-        """ Fetch a map of the epicenter of the requested quake. """
-        try:
-            return urllib2.urlopen(quakemap(*self.coords())).read()
-        except:
-            return ""
+        """ Draw a map of the epicenter of the requested quake, or fetch one
+        if the coastlines for drawing it aren't bundled.
+        """
+        lng, lat = self.coords()
+        image = maprender.epicenter_map(lng, lat)
+        if image is None:
+            image = mapcache.maps.get(quakemap(lng, lat))
+        return image
 
     def coords(self):
         """ Get the coordinates of the epicenter of the requested quake. """
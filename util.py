@@ -21,9 +21,17 @@ jinja_environment = jinja2.Environment(
         loader=jinja2.FileSystemLoader(os.path.dirname(__file__)))
 
 
+# Compiled templates, by file name.
+_templates = {}
+
+
 def get_template(filename):
-    return jinja_environment.get_template(
-            os.path.join("templates", filename))
+    template = _templates.get(filename)
+    if template is None:
+        template = jinja_environment.get_template(
+                os.path.join("templates", filename))
+        _templates[filename] = template
+    return template
 
 
 class TemplatingBaseHandler (webapp2.RequestHandler):
@@ -0,0 +1,44 @@
+""" Bounded pool of worker threads, for doing slow network work for many users
+at once.
+"""
+import Queue
+import logging
+import threading
+
+
+def run(func, items, concurrency, ):
+    """ Call a function on every item, at most `concurrency` at a time.
+    An exception from one call doesn't affect the others.
+
+    func (callable): function taking a single item.
+    items (iterable): the items to process.
+    concurrency (int): maximum number of calls in progress at once.
+
+    Returns a list of (item, result, exception) in the same order as the
+    items, where exception is None if the call succeeded.
+    """
+    items = list(items)
+    results = [None] * len(items)
+    pending = Queue.Queue()
+    for i, item in enumerate(items):
+        pending.put((i, item))
+
+    def work():
+        while True:
+            try:
+                i, item = pending.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[i] = (item, func(item), None)
+            except Exception as e:
+                logging.exception("worker failed on %r", item)
+                results[i] = (item, None, e)
+
+    threads = [threading.Thread(target=work)
+            for _ in range(max(1, min(concurrency, len(items))))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results